@@ -1,23 +1,55 @@
-import yaml
 import sys
 import os
-from threading import Timer, Thread
-from pythonosc import osc_server, dispatcher, udp_client
+from threading import Thread, Condition, Lock, RLock, Event, local
+from pythonosc import osc_message_builder, osc_packet
+from collections import namedtuple, deque, OrderedDict
+from collections.abc import Mapping
 import itertools
 import argparse
 import datetime
 import time
+import heapq
+import struct
+import hashlib
+import marshal
+import mmap
+import bisect
+import fnmatch
+import re
+import socket
+import socketserver
+import signal
+# yaml, asyncio, multiprocessing and the GUI modules are slow to import and
+# only needed by some configurations, so they are imported where they are used
+
+def parse_arguments(argv = None):
+  parser = argparse.ArgumentParser(description='Route OSC packets corresponding to scenes')
+  parser.add_argument('--no-gui', action='store_true', help="Run the scene controller purely from the command line")
+  parser.add_argument("-s", "--scenes", help="Path to scenes.yaml", metavar="FILE")
+  parser.add_argument("-i", "--input-port", metavar='N', type=int, help="Port for OSC server to listen on (Default 8000)")
+  parser.add_argument("-o", "--output-address", help="IP address and port to send feedback traffic to")
+  parser.add_argument("--log-level", choices=["debug", "info", "warning"], default="debug", help="Lowest level of log message to keep; 'info' hides the per-packet lines (Default debug)")
+  parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread", help="Server engine to receive and send with (Default thread)")
+  parser.add_argument("--metrics-port", metavar='N', type=int, help="Serve Prometheus text metrics on http://127.0.0.1:N/metrics")
+  parser.add_argument("--stats-interval", metavar='SECONDS', type=int, default=0, help="With --no-gui, print a metrics summary this often (Default off)")
+  parser.add_argument("--watch", action='store_true', help="Reload the scenes file automatically whenever it changes")
+  parser.add_argument("--no-cache", action='store_true', help="Always parse the scenes file instead of using the compiled cache")
+  parser.add_argument("--lazy", action='store_true', help="Compile each scene the first time it is triggered instead of all of them at startup")
+  parser.add_argument("--lazy-cache-mb", metavar='N', type=float, default=64, help="With --lazy, keep at most this many MB of compiled scenes (Default 64)")
+  parser.add_argument("--warm", action='store_true', help="With --lazy, compile scenes in the background until the cache is full")
+  parser.add_argument("--track-state", action='store_true', help="Remember the last value sent to each address and only send scene messages that change it")
+  parser.add_argument("--raw-routing", action='store_true', help="Forward pass-through packets byte for byte instead of decoding and re-encoding them")
+  parser.add_argument("--record", metavar="FILE", help="Write every packet received to a capture file, for replaying later with benchmarks/replay.py")
+  parser.add_argument("--workers", metavar='N', type=int, default=1, help="With --no-gui, receive on the input port from N processes at once (Linux, Default 1)")
+  return parser.parse_args(argv)
+
+# Only read the real command line when run as a script, so the module can be
+# imported (by headless.py or the benchmarks, for instance) without the GUI
+args = parse_arguments() if __name__ == "__main__" else parse_arguments(["--no-gui"])
 
-parser = argparse.ArgumentParser(description='Route OSC packets corresponding to scenes')
-parser.add_argument('--no-gui', action='store_true', help="Run the scene controller purely from the command line")
-parser.add_argument("-s", "--scenes", help="Path to scenes.yaml", metavar="FILE")
-parser.add_argument("-i", "--input-port", metavar='N', type=int, help="Port for OSC server to listen on (Default 8000)")
-parser.add_argument("-o", "--output-address", help="IP address and port to send feedback traffic to")
-args = parser.parse_args()
 
 # Only import if needed
 if not args.no_gui:
-  import signal
   import json
   import webbrowser
   import appdirs
@@ -64,54 +96,145 @@ class UserPreferences:
 debug = False
 
 active_scene = None
-log_data = []
+
+### Bounded log of structured events, formatted only when a consumer reads them
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LOG_LEVELS = { "debug": DEBUG, "info": INFO, "warning": WARNING }
+
+LogEvent = namedtuple('LogEvent', ['timestamp', 'level', 'kind', 'address', 'args', 'destination'])
+
+def format_event(event):
+  if event.kind == "send":
+    return "Sending \"" + event.address + " " + " ".join([str(s) for s in event.args]) + "\" to " + str(event.destination)
+  if event.kind == "forward":
+    # The address is the raw datagram, cut at the end of its address string
+    return "Forwarding \"" + event.address[:event.address.find(b"\x00")].decode(errors="replace") + "\" to " + str(event.destination)
+  if event.kind == "receive":
+    return "Received: " + event.address + " " + str(event.args)
+  return event.address
+
+class EventLog:
+  def __init__(self, capacity = 10000, level = DEBUG):
+    self.capacity = capacity
+    self.level = level
+    self.dropped = 0
+    self._events = [None] * capacity
+    self._start = 0
+    self._count = 0
+    self._dropped_unread = 0
+    self._lock = Lock()
+    self._listener = None
+    self._notified = False
+
+  def set_listener(self, listener):
+    # Called from whichever thread logs, the first time something happens
+    # after a drain, so a consumer can sleep until there is something to read
+    self._listener = listener
+
+  def wake(self):
+    # For changes that aren't log events, like the current scene
+    if self._listener is not None and not self._notified:
+      self._notified = True
+      self._listener()
+
+  def add(self, level, kind, address, args = None, destination = None):
+    if level < self.level:
+      return
+    event = LogEvent(time.time(), level, kind, address, args, destination)
+    with self._lock:
+      if self._count == self.capacity:
+        # Full, so overwrite the oldest event
+        self._events[self._start] = event
+        self._start = (self._start + 1) % self.capacity
+        self.dropped += 1
+        self._dropped_unread += 1
+      else:
+        self._events[(self._start + self._count) % self.capacity] = event
+        self._count += 1
+    if self._listener is not None and not self._notified:
+      self._notified = True
+      self._listener()
+
+  def debug(self, text):
+    self.add(DEBUG, "message", text)
+
+  def info(self, text):
+    self.add(INFO, "message", text)
+
+  def warning(self, text):
+    self.add(WARNING, "message", text)
+
+  def drain(self):
+    with self._lock:
+      self._notified = False
+      events = [self._events[(self._start + i) % self.capacity] for i in range(self._count)]
+      self._events = [None] * self.capacity
+      self._start = 0
+      self._count = 0
+      dropped = self._dropped_unread
+      self._dropped_unread = 0
+    if dropped > 0:
+      events.insert(0, LogEvent(time.time(), WARNING, "message", "Log overflowed, {0} older messages were dropped".format(dropped), None, None))
+    return events
+
+  def __len__(self):
+    return self._count
+
+event_log = EventLog(level = LOG_LEVELS[args.log_level])
 
 class OSCMessage:
-  def __init__(self, message, args = None, *, delay = 0):
+  # Immutable once built: slots instead of a __dict__ and the arguments as a
+  # tuple keep the one-per-routed-packet allocation small
+  __slots__ = ("_prefix", "_addr", "_delay", "_args", "_dgram")
+
+  def __init__(self, message, args = None, *, delay = 0, dgram = None):
     if debug:
       print("Creating OSCMessage from message:", message)
 
-    self._prefix = message.split("/")[1]
-    self._addr = message.split(" ")[0]
+    parts = message.split(" ")
+    self._addr = parts[0]
+    self._prefix = self._addr.split("/")[1]
     self._delay = delay
-    self._args = []
+    self._dgram = dgram
 
     if args is not None:
-      if type(args) is list:
+      if type(args) is tuple:
         self._args = args
-      elif type(args) is tuple:
-        self._args = list(itertools.chain.from_iterable([args])) # convert to array
+      elif type(args) is list:
+        self._args = tuple(args)
       else:
-        self._args = [args]
+        self._args = (args,)
     else:
-      # Go through each argument, parse it, and add it to the array in the correct type
-      for arg in message.split(" ")[1:]:
-        if self._prefix == "scene":
-          self._args.append(int(arg))
-          continue
+      # Parse each argument into the correct type
+      self._args = tuple(self.parse_argument(arg, self._prefix == "scene") for arg in parts[1:])
 
-        # Check first if it is an int
-        if arg.isdigit():
-          self._args.append(int(arg))
-          continue
+  @staticmethod
+  def parse_argument(arg, is_scene = False):
+    # Parse one argument from the configuration into the correct type
+    if is_scene:
+      return int(arg)
 
-        # Then see if if is a float
-        try:
-          self._args.append(float(arg))
-          continue
-        except ValueError:
-          pass
-          
-        # Then see if it is a boolean type
-        if arg.lower() == "true":
-          self._args.append(True)
-          continue
-        if arg.lower() == "false":
-          self._args.append(False)
-          continue
+    # Check first if it is an int
+    if arg.isdigit():
+      return int(arg)
+
+    # Then see if if is a float
+    try:
+      return float(arg)
+    except ValueError:
+      pass
 
-        # If all else fails, it must be a string
-        self._args.append(arg)
+    # Then see if it is a boolean type
+    if arg.lower() == "true":
+      return True
+    if arg.lower() == "false":
+      return False
+
+    # If all else fails, it must be a string
+    return arg
 
   @property
   def address(self):
@@ -125,72 +248,1319 @@ class OSCMessage:
   def delay(self):
     return self._delay
 
-  @delay.setter
-  def delay(self, delay):
-    self._delay = delay
 
   @property
   def prefix(self):
     return self._prefix
 
-### Generate the OSC commands that need to be sent for each scene
-# by parsing the YAML file
+  def __repr__(self):
+    return "OSCMessage({0!r}, {1!r}, delay={2!r})".format(self._addr, self._args, self._delay)
 
-class SceneParser():
+  @property
+  def dgram(self):
+    # Encoded once and reused, so compiled scenes never re-encode on send
+    if self._dgram is None:
+      builder = osc_message_builder.OscMessageBuilder(address=self._addr)
+      for arg in self._args:
+        builder.add_arg(arg)
+      self._dgram = builder.build().dgram
+    return self._dgram
+
+### Feedback messages for each scene, built once when the scenes are loaded
+
+SceneFeedback = namedtuple('SceneFeedback', ['on', 'off', 'off_float'])
+
+def scene_feedback(key):
+  address = sys.intern("/scene/" + key)
+  return SceneFeedback(OSCMessage(address, (1,)), OSCMessage(address, (0,)), OSCMessage(address, (0.0,)))
+
+### UDP sockets shared between endpoints and kept across reloads
+#
+# One socket per (ip, port, broadcast, multicast options), reference counted
+# so that it is closed when the last endpoint using it goes away.  Sockets
+# are connect()ed to their destination where possible, so sends skip the
+# address lookup.  The multicast options only take effect on sockets whose
+# destination is a multicast group.
+
+MULTICAST_DEFAULTS = (1, None, True)
+
+class PooledSocket:
+  __slots__ = ("key", "sock", "sockaddr", "connected", "refs")
+
+  def __init__(self, key, sock, sockaddr, connected):
+    self.key = key
+    self.sock = sock
+    self.sockaddr = sockaddr
+    self.connected = connected
+    self.refs = 0
+
+  def send(self, dgram):
+    if self.connected:
+      try:
+        self.sock.send(dgram)
+      except ConnectionRefusedError:
+        # A connected socket reports that nothing was listening for an
+        # earlier packet on the next send, which did not go out; try it again
+        self.sock.send(dgram)
+    else:
+      self.sock.sendto(dgram, self.sockaddr)
+
+class SocketPool:
   def __init__(self):
-    self.scene_map = None
-    self.midi_map = None
-    self.scene_names = None
-    self.loaded = False
+    self.lock = Lock()
+    self.sockets = {}
+
+  def acquire(self, ip, port, broadcast = True, multicast = MULTICAST_DEFAULTS):
+    # multicast is (ttl, interface, loop) for destinations that are groups
+    key = (ip, port, broadcast, multicast)
+    with self.lock:
+      pooled = self.sockets.get(key)
+      if pooled is None:
+        pooled = self.sockets[key] = self.open(key)
+      pooled.refs += 1
+      return pooled
+
+  def release(self, pooled):
+    with self.lock:
+      pooled.refs -= 1
+      if pooled.refs == 0:
+        del self.sockets[pooled.key]
+        pooled.sock.close()
+
+  def open(self, key):
+    ip, port, broadcast, multicast = key
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(ip, port, type=socket.SOCK_DGRAM)[0]
+    # Blocking, so a full send buffer holds the sender up rather than
+    # dropping the datagram; the asyncio engine opens non-blocking ones
+    sock = socket.socket(family, socktype, proto)
+    if broadcast:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if is_multicast(family, sockaddr[0]):
+      try:
+        set_multicast_options(sock, family, *multicast)
+      except OSError:
+        sock.close()
+        raise
+    try:
+      sock.connect(sockaddr)
+      connected = True
+    except OSError:
+      # No route yet, for instance; sendto still works once there is one
+      connected = False
+    return PooledSocket(key, sock, sockaddr, connected)
+
+  def __len__(self):
+    return len(self.sockets)
+
+def is_multicast(family, host):
+  if family == socket.AF_INET:
+    return 224 <= int(host.split(".", 1)[0]) <= 239
+  return family == socket.AF_INET6 and host.lower().startswith("ff")
+
+def set_multicast_options(sock, family, ttl, interface, loop):
+  # interface is the address of the local interface to send from for IPv4,
+  # and an interface name or index for IPv6
+  if family == socket.AF_INET:
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loop))
+    if interface is not None:
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+  else:
+    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, ttl)
+    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, int(loop))
+    if interface is not None:
+      index = interface if isinstance(interface, int) else socket.if_nametoindex(interface)
+      sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, index)
+
+socket_pool = SocketPool()
+
+### Batched sends with sendmmsg(2), so a scene goes out in one call per socket
+#
+# Only on Linux, through ctypes, and only for connected sockets so that no
+# destination address is needed per message.  Filling in the message headers
+# from Python costs more than the system calls it saves, so a SendBatch is
+# built the first time a scene fires and reused after that.  SendBatch is
+# None on other platforms, and scenes are sent one datagram at a time.
+
+SEND_BATCH_MIN = 4
+
+def load_send_batch():
+  if not sys.platform.startswith("linux"):
+    return None
+  try:
+    import ctypes
+    import errno
+    libc = ctypes.CDLL(None, use_errno=True)
+    sendmmsg = libc.sendmmsg
+  except (ImportError, OSError, AttributeError):
+    return None
 
-  def parseFromFile(self, filename):
-    config = yaml.load(open(filename, 'r'))
-    scenes = config['scenes']
-    endpoints = config['endpoints']
-    mapping = config['map']
+  class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_char_p), ("iov_len", ctypes.c_size_t)]
+
+  class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+      ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+      ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t), ("msg_flags", ctypes.c_int)]
+
+  class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+  sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+  sendmmsg.restype = ctypes.c_int
+  size = ctypes.sizeof(mmsghdr)
+
+  class SendBatch:
+    def __init__(self, dgrams):
+      self.count = len(dgrams)
+      self.iovecs = (iovec * self.count)()
+      self.messages = (mmsghdr * self.count)()
+      for i, dgram in enumerate(dgrams):
+        # c_char_p points at the bytes object itself, so nothing is copied
+        self.iovecs[i].iov_base = dgram
+        self.iovecs[i].iov_len = len(dgram)
+        self.messages[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+        self.messages[i].msg_hdr.msg_iovlen = 1
+      self.address = ctypes.addressof(self.messages)
+
+    def send(self, sock):
+      sent = 0
+      refused = False
+      while sent < self.count:
+        result = sendmmsg(sock.fileno(), self.address + sent * size, self.count - sent, 0)
+        if result < 0:
+          error = ctypes.get_errno()
+          if error == errno.ECONNREFUSED and not refused:
+            # Left over from an earlier packet, as in Endpoint.send
+            refused = True
+            continue
+          raise OSError(error, os.strerror(error))
+        sent += result
+
+  return SendBatch
+
+SendBatch = load_send_batch()
+
+### An output prefix, holding a pooled socket for each of its destinations
+#
+# Most endpoints have one destination.  Extra destinations get the same
+# datagrams, encoded once and sent from the same bytes object on each
+# socket, which is how a primary and a backup console are kept in step.
+# A multicast group is a single destination that every subscriber receives.
+
+def parse_destination(value):
+  # "ip:port" (with the ip in brackets for IPv6) or { ip: ..., port: ... },
+  # as an (ip, port) tuple, or None if it cannot be read
+  if isinstance(value, dict):
+    ip, port = value.get('ip'), value.get('port')
+  elif isinstance(value, str) and ":" in value:
+    ip, _, port = value.rpartition(":")
+    ip = ip[1:-1] if ip.startswith("[") and ip.endswith("]") else ip
+  else:
+    return None
+  try:
+    port = int(port)
+  except (TypeError, ValueError):
+    return None
+  if not isinstance(ip, str) or ip == "" or not 0 < port < 65536:
+    return None
+  return (ip, port)
+
+class Endpoint:
+  def __init__(self, prefix, ip, port, *, destinations = (), multicast_ttl = 1, multicast_interface = None, multicast_loop = True, track_state = True, bundle = False, mtu = 1472, bundle_timetag = 0, coalesce = 0, coalesce_addresses = None, queue = 0, overflow = "drop-oldest", rate = 0):
+    self.prefix = prefix
+    # ip and port may both be None when every destination is in
+    # destinations, but one without the other is a mistake
+    self.destinations = []
+    if ip is not None or port is not None:
+      primary = parse_destination({ 'ip': ip, 'port': port })
+      if primary is None:
+        raise ValueError("Endpoint \"{0}\" needs an ip and port or a list of destinations".format(prefix))
+      self.destinations.append(primary)
+    for destination in destinations:
+      if destination not in self.destinations:
+        self.destinations.append(destination)
+    if len(self.destinations) == 0:
+      raise ValueError("Endpoint \"{0}\" needs an ip and port or a list of destinations".format(prefix))
+    self.ip, self.port = self.destinations[0]
+    self.track_state = track_state
+    self.bundle = bundle
+    self.mtu = mtu
+    self.bundle_timetag = bundle_timetag
+    self.coalesce = coalesce
+    # Without patterns every pass-through address is coalesced
+    self.coalesce_pattern = re.compile("|".join(fnmatch.translate(pattern) for pattern in coalesce_addresses)) if coalesce_addresses else None
+    # Pacing needs somewhere to hold packets, so it implies a queue
+    self.queue = queue if queue > 0 else (1000 if rate > 0 else 0)
+    self.overflow = overflow
+    self.rate = rate
+    # Identifies the endpoint's receivers in the state and coalescing tables
+    self.address = self.destinations[0] if len(self.destinations) == 1 else tuple(self.destinations)
+    multicast = (multicast_ttl, multicast_interface, multicast_loop)
+    self.pooled_sockets = []
+    try:
+      for destination_ip, destination_port in self.destinations:
+        self.pooled_sockets.append(socket_pool.acquire(destination_ip, destination_port, multicast=multicast))
+    except:
+      for pooled in self.pooled_sockets:
+        socket_pool.release(pooled)
+      raise
+    self.pooled = self.pooled_sockets[0]
+    self.fanout = len(self.pooled_sockets) > 1
+    self.closed = False
+
+  def send(self, dgram):
+    if not self.fanout:
+      self.pooled.send(dgram)
+      return
+    # One unreachable destination must not hold back the others
+    error = None
+    for pooled in self.pooled_sockets:
+      try:
+        pooled.send(dgram)
+      except OSError as e:
+        error = e
+    if error is not None:
+      raise error
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      for pooled in self.pooled_sockets:
+        socket_pool.release(pooled)
+
+  def coalesces(self, address):
+    return self.coalesce > 0 and (self.coalesce_pattern is None or self.coalesce_pattern.match(address) is not None)
+
+  def __str__(self):
+    return ", ".join(ip + ":" + str(port) for ip, port in self.destinations)
+
+### Precompiled scenes: encoded datagrams and their endpoints, grouped by delay
+
+PlanPacket = namedtuple('PlanPacket', ['endpoint', 'dgram', 'messages'])
+PlanBucket = namedtuple('PlanBucket', ['delay', 'packets', 'batches', 'unbatched'])
+ScenePlan = namedtuple('ScenePlan', ['key', 'buckets'])
+
+class PlanBatch:
+  # The packets of one bucket for one set of sockets, sent with a single
+  # sendmmsg on each
+  __slots__ = ("endpoint", "sockets", "dgrams", "_batch")
+
+  def __init__(self, endpoint, sockets, dgrams):
+    self.endpoint = endpoint
+    self.sockets = sockets
+    self.dgrams = dgrams
+    self._batch = None
+
+  @property
+  def batch(self):
+    if self._batch is None:
+      self._batch = SendBatch(self.dgrams)
+    return self._batch
+
+### OSC bundles, for endpoints that should apply a scene's messages atomically
+
+BUNDLE_HEADER = b"#bundle\x00"
+TIMETAG_IMMEDIATELY = struct.pack(">Q", 1)
+NTP_EPOCH_OFFSET = 2208988800 # Seconds from 1900 (NTP) to 1970 (Unix)
+
+def build_bundle(messages, timetag = TIMETAG_IMMEDIATELY):
+  return BUNDLE_HEADER + timetag + b"".join(struct.pack(">i", len(message.dgram)) + message.dgram for message in messages)
+
+def split_bundles(messages, mtu):
+  # Pack messages in order into as few bundles as fit in one datagram each.
+  # A message too big to share a bundle gets one to itself.
+  bundles = []
+  current = []
+  size = len(BUNDLE_HEADER) + len(TIMETAG_IMMEDIATELY)
+  for message in messages:
+    element = 4 + len(message.dgram)
+    if len(current) > 0 and size + element > mtu:
+      bundles.append(current)
+      current = []
+      size = len(BUNDLE_HEADER) + len(TIMETAG_IMMEDIATELY)
+    current.append(message)
+    size += element
+  if len(current) > 0:
+    bundles.append(current)
+  return bundles
+
+def stamp_bundle(dgram, offset):
+  # Replace the "immediately" timetag with one `offset` seconds from now
+  seconds = time.time() + offset + NTP_EPOCH_OFFSET
+  return dgram[:8] + struct.pack(">II", int(seconds), int((seconds % 1) * 4294967296)) + dgram[16:]
+
+### Counters and latency histograms for the hot path
+#
+# Each thread records into its own shard without taking a lock, and the
+# shards are only merged when someone reads the metrics.
+
+HISTOGRAM_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+METRIC_HELP = {
+  "packets_received": ("counter", None, "OSC packets received"),
+  "packets_routed": ("counter", "prefix", "Packets passed through to an endpoint"),
+  "packets_dropped": ("counter", "prefix", "Packets dropped because their prefix has no endpoint"),
+  "scene_triggers": ("counter", "scene", "Scene changes"),
+  "messages_skipped": ("counter", None, "Scene messages not sent because the endpoint already had that value"),
+  "send_errors": ("counter", "endpoint", "Sends that failed with a socket error"),
+  "messages_coalesced": ("counter", "prefix", "Pass-through values replaced by a newer one before they were sent"),
+  "queue_dropped": ("counter", "prefix", "Packets dropped because the endpoint's send queue was full"),
+  "handler_seconds": ("histogram", None, "Time spent handling each received packet"),
+  "cue_jitter_seconds": ("histogram", None, "How far each delayed scene cue fired from its planned offset"),
+  "scheduled_sends": ("gauge", None, "Delayed sends waiting to go out"),
+  "open_sockets": ("gauge", None, "UDP sockets open for sending to endpoints"),
+}
+
+def escape_label(value):
+  # Prometheus label values are quoted, with \\, \" and \n escaped
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+  def __init__(self):
+    self._local = local()
+    self._shards = []
+    self._shards_lock = Lock()
+    self.gauges = {}
+
+  def _shard(self):
+    try:
+      return self._local.shard
+    except AttributeError:
+      shard = ({}, {})
+      with self._shards_lock:
+        self._shards.append(shard)
+      self._local.shard = shard
+      return shard
+
+  def count(self, name, label = None, amount = 1):
+    counters = self._shard()[0]
+    key = (name, label)
+    counters[key] = counters.get(key, 0) + amount
+
+  def observe(self, name, seconds):
+    histograms = self._shard()[1]
+    histogram = histograms.get(name)
+    if histogram is None:
+      # One slot per bucket plus +Inf, then the sum and the count
+      histogram = histograms[name] = [0] * (len(HISTOGRAM_BOUNDS) + 3)
+    histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+    histogram[-2] += seconds
+    histogram[-1] += 1
+
+  def gauge(self, name, callback):
+    self.gauges[name] = callback
+
+  def snapshot(self):
+    counters = {}
+    histograms = {}
+    with self._shards_lock:
+      shards = list(self._shards)
+    for shard_counters, shard_histograms in shards:
+      for key, value in list(shard_counters.items()):
+        counters[key] = counters.get(key, 0) + value
+      for name, values in list(shard_histograms.items()):
+        merged = histograms.setdefault(name, [0] * len(values))
+        for i, value in enumerate(list(values)):
+          merged[i] += value
+    gauges = { name: callback() for name, callback in self.gauges.items() }
+    return counters, histograms, gauges
+
+  def prometheus(self):
+    counters, histograms, gauges = self.snapshot()
+    lines = []
+    for name, (kind, label, description) in METRIC_HELP.items():
+      metric = "osc_" + name + ("_total" if kind == "counter" else "")
+      lines.append("# HELP {0} {1}".format(metric, description))
+      lines.append("# TYPE {0} {1}".format(metric, kind))
+      if kind == "counter":
+        for (counter_name, value), count in sorted(counters.items(), key=lambda item: str(item[0])):
+          if counter_name == name:
+            labels = "" if value is None else '{{{0}="{1}"}}'.format(label, escape_label(value))
+            lines.append("{0}{1} {2}".format(metric, labels, count))
+      elif kind == "histogram" and name in histograms:
+        values = histograms[name]
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS + ("+Inf",), values):
+          cumulative += count
+          lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound, cumulative))
+        lines.append("{0}_sum {1}".format(metric, values[-2]))
+        lines.append("{0}_count {1}".format(metric, values[-1]))
+      elif kind == "gauge" and name in gauges:
+        lines.append("{0} {1}".format(metric, gauges[name]))
+    return "\n".join(lines) + "\n"
+
+  def summary(self):
+    counters, histograms, gauges = self.snapshot()
+    totals = {}
+    for (name, _), count in counters.items():
+      totals[name] = totals.get(name, 0) + count
+    text = "received {0}, routed {1}, dropped {2}, scene changes {3}, send errors {4}, scheduled {5}".format(
+      totals.get("packets_received", 0), totals.get("packets_routed", 0), totals.get("packets_dropped", 0),
+      totals.get("scene_triggers", 0), totals.get("send_errors", 0), gauges.get("scheduled_sends", 0))
+    handler = histograms.get("handler_seconds")
+    if handler is not None and handler[-1] > 0:
+      text += ", mean handler time {0:.3f}ms".format(handler[-2] / handler[-1] * 1000)
+    jitter = histograms.get("cue_jitter_seconds")
+    if jitter is not None and jitter[-1] > 0:
+      text += ", mean cue jitter {0:.3f}ms".format(jitter[-2] / jitter[-1] * 1000)
+    return text
+
+class MetricsServer:
+  def __init__(self, metrics, port):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = HTTPServer(("127.0.0.1", port), Handler)
+    self.thread = Thread(target=self.server.serve_forever, name="OSCMetrics", daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+### Run delayed sends from one scheduler thread instead of a Timer per message
+
+class ScheduledCall:
+  def __init__(self, deadline, callback, args):
+    self.deadline = deadline
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class Scheduler:
+  def __init__(self, spin_window = 0.002):
+    # Deadlines are on the monotonic clock.  The thread sleeps until
+    # spin_window seconds before a deadline and yields out the rest, which
+    # keeps the jitter bounded without burning a core between cues.
+    self.spin_window = spin_window
+    self._queue = []
+    self._counter = itertools.count()
+    self._condition = Condition()
+    self._thread = None
+
+  def schedule(self, delay, callback, *args):
+    return self.schedule_at(time.monotonic() + delay, callback, *args)
+
+  def schedule_at(self, deadline, callback, *args):
+    call = ScheduledCall(deadline, callback, args)
+    with self._condition:
+      heapq.heappush(self._queue, (deadline, next(self._counter), call))
+      if self._thread is None:
+        self._thread = Thread(target=self._run, name="OSCScheduler", daemon=True)
+        self._thread.start()
+      elif self._queue[0][2] is call:
+        self._condition.notify()
+    return call
+
+  def cancel_all(self):
+    with self._condition:
+      for _, _, call in self._queue:
+        call.cancel()
+      self._queue = []
+
+  def __len__(self):
+    return len(self._queue)
+
+  def _next_due(self):
+    with self._condition:
+      while True:
+        if len(self._queue) == 0:
+          self._condition.wait()
+          continue
+        deadline, _, call = self._queue[0]
+        if call.cancelled:
+          heapq.heappop(self._queue)
+          continue
+        remaining = deadline - time.monotonic()
+        if remaining <= self.spin_window:
+          heapq.heappop(self._queue)
+          return call
+        self._condition.wait(remaining - self.spin_window)
+
+  def _run(self):
+    while True:
+      call = self._next_due()
+      while time.monotonic() < call.deadline:
+        time.sleep(0)
+      if call.cancelled:
+        continue
+      try:
+        call.callback(*call.args)
+      except Exception as e:
+        event_log.warning("Error running scheduled send: {0}".format(e))
+
+### Coalesce high-rate pass-through streams, such as a fader being dragged
+#
+# The first value for an address goes straight out and opens a window of
+# the endpoint's `coalesce` seconds.  Values arriving during the window
+# replace each other, and whichever is latest is sent when it closes (which
+# opens a new window), so each address gets at most one packet per window
+# and the final value is always delivered.
+
+class Coalescer:
+  def __init__(self, controller):
+    self.controller = controller
+    self.lock = Lock()
+    self.windows = {}
+
+  def hold(self, endpoint, address, dgram):
+    # True if the value was held for the end of the window, False if the
+    # caller should send it now
+    key = (endpoint.address, address)
+    with self.lock:
+      if key in self.windows:
+        if self.windows[key] is not None:
+          self.controller.metrics.count("messages_coalesced", endpoint.prefix)
+        self.windows[key] = (endpoint, dgram)
+        return True
+      self.windows[key] = None
+    self.controller.schedule(endpoint.coalesce, self.flush, key, endpoint.coalesce)
+    return False
+
+  def discard(self, endpoint, address):
+    # A scene is setting this address, so a held value must not overwrite it
+    with self.lock:
+      if self.windows.get((endpoint.address, address)) is not None:
+        self.windows[(endpoint.address, address)] = None
+
+  def flush(self, key, window):
+    with self.lock:
+      held = self.windows.pop(key, None)
+      if held is not None:
+        self.windows[key] = None
+    if held is not None:
+      self.controller.send_coalesced(held[0], key[1], held[1])
+      self.controller.schedule(window, self.flush, key, window)
+
+### Bounded outbound queue with its own writer thread, for endpoints with a `queue`
+#
+# Sends to a queued endpoint return at once, so a burst to one slow device
+# never holds up the receiving thread or the other endpoints.  When the
+# queue is full, `overflow` decides whether the oldest queued packet or the
+# new one is dropped, and `rate` spaces the writes out to at most that many
+# packets per second.
+
+class SendQueue:
+  def __init__(self, endpoint, controller):
+    self.endpoint = endpoint
+    self.controller = controller
+    self.size = endpoint.queue
+    self.drop_newest = endpoint.overflow == "drop-newest"
+    self.interval = 1.0 / endpoint.rate if endpoint.rate > 0 else 0
+    self.items = deque()
+    self.condition = Condition()
+    self.closing = False
+    self.thread = Thread(target=self._run, name="OSCSend-" + endpoint.prefix, daemon=True)
+    self.thread.start()
+
+  def put(self, dgram):
+    with self.condition:
+      if len(self.items) >= self.size:
+        self.controller.metrics.count("queue_dropped", self.endpoint.prefix)
+        if self.drop_newest:
+          return
+        self.items.popleft()
+      self.items.append(dgram)
+      self.condition.notify()
+
+  def close(self):
+    # The writer exits once it has sent what is already queued
+    with self.condition:
+      self.closing = True
+      self.condition.notify()
+
+  def __len__(self):
+    return len(self.items)
+
+  def _run(self):
+    next_send = 0
+    while True:
+      with self.condition:
+        while len(self.items) == 0 and not self.closing:
+          self.condition.wait()
+        if len(self.items) == 0:
+          return
+        dgram = self.items.popleft()
+      if self.interval > 0:
+        wait = next_send - time.monotonic()
+        if wait > 0:
+          time.sleep(wait)
+        # The next packet waits a full interval after this one, however
+        # long the queue sat idle before it
+        next_send = max(next_send, time.monotonic()) + self.interval
+      try:
+        self.endpoint.send(dgram)
+      except OSError as e:
+        self.controller.send_failed(self.endpoint, e)
+
+### Compiled cache of resolved scenes, so warm starts skip YAML parsing
+#
+# One cache file per scenes file, named after its path and stamped with the
+# hash of the file contents.  It holds the raw config (used to diff reloads)
+# and every scene's resolved messages with their encoded datagrams, written
+# with marshal and read back through a memory map.
+
+CACHE_VERSION = 3
+
+def yaml_loader():
+  # The fastest loader this PyYAML was built with
+  import yaml
+  return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def compiled_cache_path(filename):
+  name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest() + ".cache"
+  try:
+    import appdirs
+    cache_dir = os.path.join(appdirs.user_data_dir("OSCSceneController", "SteffeyDev"), "cache")
+  except ImportError:
+    cache_dir = os.path.dirname(os.path.abspath(filename))
+    name = "." + name
+  return os.path.join(cache_dir, name)
+
+def load_compiled_cache(filename, digest):
+  try:
+    with open(compiled_cache_path(filename), 'rb') as cache_file:
+      with mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        version, cached_digest, raw, scenes = marshal.loads(data)
+  except (OSError, ValueError, EOFError, TypeError):
+    return None
+  if version != CACHE_VERSION or cached_digest != digest:
+    return None
+  return raw, scenes
+
+def save_compiled_cache(filename, digest, config):
+  scenes = []
+  for scene in config.raw['scenes']:
+    key = scene['key']
+    messages = [(message.address, tuple(message.arguments), message.delay, message.dgram) for message in config.scene_map[key]]
+    scenes.append((key, scene['name'], scene.get('midi'), messages, tuple(config.scene_warnings.get(key, ()))))
+
+  path = compiled_cache_path(filename)
+  try:
+    data = marshal.dumps((CACHE_VERSION, digest, config.raw, scenes))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as cache_file:
+      cache_file.write(data)
+    os.replace(path + ".tmp", path)
+  except (OSError, ValueError) as e:
+    # Not fatal: the YAML may hold types marshal can't store, or the
+    # directory may be read only.  The next start just parses the YAML again.
+    if debug:
+      print("Could not write compiled cache:", e)
+
+### Scene state shared between worker processes
+#
+# With --workers every process receives part of the traffic, so the current
+# scene lives in shared memory and scene changes are made under one lock.
+
+class SharedSceneState:
+  def __init__(self, size = 1024):
+    import multiprocessing
+    self.lock = multiprocessing.Lock()
+    self._key = multiprocessing.Array('c', size, lock=False)
+
+  def get(self):
+    return self._key.value.decode() or None
+
+  def set(self, key):
+    try:
+      self._key.value = (key or "").encode()
+    except ValueError:
+      event_log.warning("Scene key '{0}' is too long to share between workers".format(key))
+
+### Resolve incoming addresses with hash lookups instead of regex matching
+#
+# Only the first segment of an address decides where it goes, so one scan
+# for the second "/" followed by a dictionary lookup resolves any address,
+# however many scenes and endpoints are loaded.
+
+class RoutingIndex:
+  def __init__(self, config):
+    self.scenes = set(config.scene_map)
+    self.midi = dict(config.midi_map)
+    self.endpoints = config.endpoints
+
+  def resolve_scene(self, address):
+    # The scene key for /scene/<key> or /midi-scene/<value>, or None
+    if address.startswith("/scene/"):
+      key = address[7:]
+      return key if key in self.scenes else None
+    if address.startswith("/midi-scene/"):
+      try:
+        return self.midi.get(int(round(float(address[12:]) * 127)))
+      except (ValueError, OverflowError):
+        # Not a number, NaN, or infinite
+        return None
+    return None
 
+### Generate the OSC commands that need to be sent for each scene
+# by parsing the YAML file
+
+class CompiledConfig:
+  # Everything the controller needs to serve one version of the scenes file.
+  # A new one is built off to the side on every load and swapped in whole.
+  def __init__(self, raw):
+    self.raw = raw
     self.scene_map = {}
+    self.scene_plans = {}
     self.scene_names = {}
     self.midi_map = {}
+    self.endpoints = {}
+    self.endpoint_settings = {}
+    self.forward_table = {}
     self.udp_clients = {}
     self.udp_client_strings = {}
+    self.feedback = {}
+    # Configuration warnings raised while compiling each scene, kept so
+    # that a warm start from the compiled cache can show them again
+    self.scene_warnings = {}
+    self.lazy_scenes = None
+    self.index = RoutingIndex(self)
+
+  def build_index(self):
+    # Called once every scene is compiled, before the config is swapped in
+    self.index = RoutingIndex(self)
+    self.feedback = { key: scene_feedback(key) for key in self.scene_map }
+
+  def add_endpoint(self, settings, endpoint):
+    prefix = settings['prefix']
+    self.endpoints[prefix] = endpoint
+    self.endpoint_settings[prefix] = settings
+    self.udp_clients[prefix] = endpoint
+    self.udp_client_strings[prefix] = str(endpoint)
+    if prefix not in ("scene", "midi-scene"):
+      self.forward_table[prefix.encode()] = endpoint
+
+### Compile scenes on first use, keeping the most recently used ones
+#
+# With --lazy only the scene keys, names and MIDI notes are read at load
+# time.  A scene's messages and plan are compiled the first time it is
+# triggered (or by the warming thread) and kept in an LRU; once the
+# estimated size of everything compiled passes the cap, the scenes used
+# longest ago are dropped and compiled again if they come back.
+
+# Bytes a compiled message costs besides its datagram: the OSCMessage, its
+# arguments and its PlanPacket (measured with tracemalloc)
+MESSAGE_BYTES = 440
+
+class LazyScenes:
+  def __init__(self, parser, config, limit):
+    self.parser = parser
+    self.config = config
+    self.limit = limit
+    self.scenes = OrderedDict((scene['key'], scene) for scene in config.raw['scenes'])
+    self.entries = OrderedDict()
+    self.size = 0
+    self.lock = Lock()
+    self.warming = False
+
+  def get(self, key):
+    # The (messages, plan) for a scene, compiling it if it isn't held, or
+    # None if it does not compile
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+        return entry
+      scene = self.scenes[key]
+      try:
+        messages = self.parser.scene_messages(scene, self.config.raw['map'])
+        entry = (messages, self.parser.compile_plan(key, messages, self.config.endpoints))
+      except Exception as e:
+        # Called from the server thread, which must keep running
+        event_log.warning("\nCould not compile scene '{0}': {1!r}".format(key, e))
+        return None
+      self.add(key, entry)
+      event_log.debug("Compiled scene {0} ({1} cached, {2:.1f}MB)".format(key, len(self.entries), self.size / (1024 * 1024)))
+      return entry
+
+  def add(self, key, entry):
+    self.entries[key] = entry
+    self.size += scene_size(entry[0])
+    # Always keep the scene just added, however big it is
+    while self.size > self.limit and len(self.entries) > 1:
+      _, (messages, _) = self.entries.popitem(last=False)
+      self.size -= scene_size(messages)
+
+  def adopt(self, old, keys, changed_prefixes):
+    # Carry compiled scenes that a reload left unchanged over from the old
+    # config, least recently used first so the order survives
+    with old.lock:
+      entries = [(key, entry) for key, entry in old.entries.items() if key in keys]
+    with self.lock:
+      for key, entry in entries:
+        if not any(message.prefix in changed_prefixes for message in entry[0]):
+          self.add(key, entry)
+
+  def warm(self):
+    # Compile scenes in file order in the background until the cap is
+    # reached, so warming never pushes out scenes that were triggered
+    def run():
+      for key in self.scenes:
+        if not self.warming or self.size >= self.limit:
+          break
+        self.get(key)
+      self.warming = False
+    self.warming = True
+    Thread(target=run, name="OSCSceneWarmer", daemon=True).start()
+
+  def stop_warming(self):
+    self.warming = False
+
+  def __len__(self):
+    return len(self.entries)
+
+def scene_size(messages):
+  return sum(len(message.dgram) + MESSAGE_BYTES for message in messages)
+
+class LazySceneView(Mapping):
+  # scene_map and scene_plans for a lazy config.  Lookups compile; checking
+  # for a key or iterating the keys does not.
+  def __init__(self, scenes, part):
+    self.scenes = scenes
+    self.part = part
+
+  def __getitem__(self, key):
+    entry = self.scenes.get(key) if key in self.scenes.scenes else None
+    if entry is None:
+      raise KeyError(key)
+    return entry[self.part]
+
+  def __contains__(self, key):
+    return key in self.scenes.scenes
+
+  def __iter__(self):
+    return iter(self.scenes.scenes)
+
+  def __len__(self):
+    return len(self.scenes.scenes)
+
+### Delays in the scenes file: "250ms", "1.5s", or a bare number of seconds
+
+DELAY_PATTERN = re.compile(r"^\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|s)?\s*$")
+
+def parse_delay(value):
+  # Returns the delay in seconds, rounded to the millisecond, or None if
+  # it cannot be read
+  if isinstance(value, bool):
+    return None
+  if isinstance(value, (int, float)):
+    return round(value, 3) if value >= 0 else None
+  match = DELAY_PATTERN.match(str(value))
+  if match is None:
+    return None
+  seconds = float(match.group(1))
+  if match.group(2) == "ms":
+    seconds /= 1000
+  return round(seconds, 3)
 
-    print("\nOutput Settings")
-    udp_clients = {}
-    for endpoint in endpoints:
-      self.udp_clients[endpoint['prefix']] = udp_client.SimpleUDPClient(endpoint['ip'], endpoint['port'], allow_broadcast=True)
-      self.udp_client_strings[endpoint['prefix']] = endpoint['ip'] + ":" + str(endpoint['port'])
-      print("Sending commands that start with /" + endpoint['prefix'] + " to " + endpoint['ip'] + ":" + str(endpoint['port']))
+# Stands in for a map key that is not there when comparing maps
+MISSING = object()
+
+class SceneParser():
+  def __init__(self):
+    self.config = CompiledConfig(None)
+    self.loaded = False
+    self.use_cache = True
+    # Set lazy to compile each scene on first use, holding at most
+    # lazy_limit bytes of compiled scenes; warm compiles them in the background
+    self.lazy = False
+    self.lazy_limit = 64 * 1024 * 1024
+    self.warm = False
+    # Messages and list-notation maps resolved while compiling, shared by
+    # every scene that uses them and cleared on each load
+    self.shared_messages = {}
+    self.list_maps = {}
+    # Map subtrees already compared during a reload, by identity
+    self.compared_subtrees = {}
+    # Collects the warnings of the scene being compiled
+    self.warnings = None
+    # The watcher thread and the GUI can both start a load; they take turns,
+    # as each builds on the config the last one published
+    self.load_lock = RLock()
+
+  def load_yaml(self, filename):
+    # Returns the raw config, the cached scenes if the compiled cache
+    # matches the file (else None), and the hash of the file contents
+    with open(filename, 'rb') as scene_file:
+      data = scene_file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    # The cache holds every scene compiled, which is what lazy mode avoids
+    if self.use_cache and not self.lazy:
+      cached = load_compiled_cache(filename, digest)
+      if cached is not None:
+        return cached[0], cached[1], digest
+    import yaml
+    return yaml.load(data, Loader=yaml_loader()), None, digest
 
-    for scene in scenes:
-      arr = []
+  def parseFromFile(self, filename):
+    with self.load_lock:
+      self.parse_file(filename)
 
-      for key, value in scene.items():
-        if not (key == "key" or key == "name" or key == "midi"):
-          self.get_commands(key, value, mapping[key], arr)
-      
-      if debug:
-        print("Array generated for scene " + scene['name'] + ":")
-        print(arr)
-        print()
+  def reloadFromFile(self, filename):
+    with self.load_lock:
+      return self.reload_file(filename)
 
-      if 'midi' in scene:
-        self.midi_map[scene['midi']] = scene['key']
+  def parse_file(self, filename):
+    old = self.config
+    self.shared_messages = {}
+    self.list_maps = {}
+    raw, cached_scenes, digest = self.load_yaml(filename)
+    config = CompiledConfig(raw)
 
-      self.scene_map[scene['key']] = arr
-      self.scene_names[scene['key']] = scene['name']
+    try:
+      print("\nOutput Settings")
+      for endpoint in raw['endpoints']:
+        config.add_endpoint(endpoint, self.create_endpoint(endpoint))
+        print("Sending commands that start with /" + endpoint['prefix'] + " to " + str(config.endpoints[endpoint['prefix']]))
+
+      if self.lazy:
+        self.index_scenes(config)
+      elif cached_scenes is not None:
+        for key, name, midi, messages, warnings in cached_scenes:
+          arr = [OSCMessage(address, args, delay=delay, dgram=dgram) for address, args, delay, dgram in messages]
+          config.scene_map[key] = arr
+          config.scene_plans[key] = self.compile_plan(key, arr, config.endpoints)
+          config.scene_names[key] = name
+          if midi is not None:
+            config.midi_map[midi] = key
+          if len(warnings) > 0:
+            config.scene_warnings[key] = list(warnings)
+        self.replay_warnings(config)
+      else:
+        for scene in raw['scenes']:
+          self.compile_scene(scene, raw['map'], config)
+        if self.use_cache:
+          save_compiled_cache(filename, digest, config)
 
+      config.build_index()
+    except:
+      self.release_new_endpoints(old, config)
+      raise
+    self.config = config
     self.loaded = True
+    self.close_unused_endpoints(old, config)
+    if self.lazy and self.warm:
+      config.lazy_scenes.warm()
+
+  def reload_file(self, filename):
+    # Only recompile what changed: endpoints whose settings are the same
+    # keep their sockets, and scenes whose own definition, map subtrees and
+    # endpoints are all unchanged keep their compiled plans.  The new
+    # config is published with a single assignment, so a trigger running
+    # on the server thread sees either the old config or the new one.
+    if not self.loaded:
+      self.parse_file(filename)
+      return len(self.config.scene_map), 0
+
+    old = self.config
+    self.shared_messages = {}
+    self.list_maps = {}
+    raw, cached_scenes, digest = self.load_yaml(filename)
+    config = CompiledConfig(raw)
+
+    try:
+      changed_prefixes = set(old.endpoints.keys())
+      for endpoint in raw['endpoints']:
+        prefix = endpoint['prefix']
+        if old.endpoint_settings.get(prefix) == endpoint:
+          config.add_endpoint(endpoint, old.endpoints[prefix])
+          changed_prefixes.discard(prefix)
+        else:
+          config.add_endpoint(endpoint, self.create_endpoint(endpoint))
+          changed_prefixes.add(prefix)
+          print("Sending commands that start with /" + prefix + " to " + str(config.endpoints[prefix]))
+
+      old_scenes = { scene['key']: scene for scene in old.raw['scenes'] }
+      old_mapping = old.raw['map']
+      mapping = raw['map']
+      self.compared_subtrees = {}
+
+      recompiled = 0
+      if self.lazy:
+        self.index_scenes(config)
+        unchanged = set()
+      for scene in raw['scenes']:
+        key = scene['key']
+        if (old_scenes.get(key) == scene
+            and all(self.same_references(value, old_mapping.get(map_key, MISSING), mapping.get(map_key, MISSING))
+                    for map_key, value in scene.items() if map_key not in ("key", "name", "midi"))):
+          if self.lazy:
+            unchanged.add(key)
+            continue
+          messages = old.scene_map[key]
+          if any(message.prefix in changed_prefixes for message in messages):
+            config.scene_plans[key] = self.compile_plan(key, messages, config.endpoints)
+          else:
+            config.scene_plans[key] = old.scene_plans[key]
+          config.scene_map[key] = messages
+          config.scene_names[key] = scene['name']
+          if 'midi' in scene:
+            config.midi_map[scene['midi']] = key
+          if key in old.scene_warnings:
+            config.scene_warnings[key] = old.scene_warnings[key]
+        else:
+          if not self.lazy:
+            self.compile_scene(scene, mapping, config)
+          recompiled += 1
 
+      self.compared_subtrees = {}
+
+      if self.lazy and old.lazy_scenes is not None:
+        old.lazy_scenes.stop_warming()
+        config.lazy_scenes.adopt(old.lazy_scenes, unchanged, changed_prefixes)
+
+      config.build_index()
+    except:
+      self.release_new_endpoints(old, config)
+      raise
+    self.config = config
+    self.close_unused_endpoints(old, config)
+    if self.lazy:
+      if self.warm:
+        config.lazy_scenes.warm()
+    elif self.use_cache and cached_scenes is None:
+      save_compiled_cache(filename, digest, config)
+    return recompiled, len(config.scene_map) - recompiled
+
+  def same_references(self, value, old, new):
+    # Whether the parts of the map that a scene value reads are the same in
+    # the old and new maps.  Follows get_commands: a dict descends into the
+    # map, a single selection reads one entry, and anything else (a list,
+    # a MIDI value) reads the whole subtree.
+    if isinstance(value, dict) and isinstance(old, dict) and isinstance(new, dict):
+      return all(self.same_references(_value, old.get(_key, MISSING), new.get(_key, MISSING)) for _key, _value in value.items())
+    if isinstance(value, str) and isinstance(old, dict) and isinstance(new, dict):
+      string = value.split(" ")[0]
+      return old.get(string, MISSING) == new.get(string, MISSING)
+    return self.same_subtree(old, new)
+
+  def same_subtree(self, old, new):
+    # Many scenes read the same list maps, so each pair is compared once
+    # per reload
+    key = (id(old), id(new))
+    same = self.compared_subtrees.get(key)
+    if same is None:
+      same = self.compared_subtrees[key] = old == new
+    return same
+
+  def release_new_endpoints(self, old, config):
+    # A load that failed part-way closes the endpoints it opened, keeping
+    # the ones the current config still uses
+    current = set(old.endpoints.values())
+    for endpoint in config.endpoints.values():
+      if endpoint not in current:
+        endpoint.close()
+
+  def close_unused_endpoints(self, old, config):
+    # Sockets are pooled by destination, so an endpoint whose settings
+    # changed but whose address did not keeps the same socket
+    current = set(config.endpoints.values())
+    for endpoint in old.endpoints.values():
+      if endpoint not in current:
+        endpoint.close()
+
+  def endpoint_delay(self, settings, name):
+    # A time setting of an endpoint in seconds, or 0 if it is unset or
+    # can't be read
+    value = settings.get(name, 0)
+    seconds = parse_delay(value)
+    if seconds is None:
+      event_log.warning("\nConfiguration Warning - Could not read {0} \"{1}\" of endpoint \"{2}\"".format(name, value, settings['prefix']))
+      return 0
+    return seconds
+
+  def create_endpoint(self, settings):
+    destinations = []
+    for value in settings.get('destinations') or ():
+      destination = parse_destination(value)
+      if destination is None:
+        event_log.warning("\nConfiguration Warning - Could not read destination \"{0}\" of endpoint \"{1}\"".format(value, settings['prefix']))
+      else:
+        destinations.append(destination)
+    return Endpoint(settings['prefix'], settings.get('ip'), settings.get('port'),
+      destinations=destinations,
+      multicast_ttl=settings.get('multicast_ttl', 1),
+      multicast_interface=settings.get('multicast_interface'),
+      multicast_loop=settings.get('multicast_loop', True),
+      track_state=settings.get('track_state', True),
+      bundle=settings.get('bundle', False),
+      mtu=settings.get('mtu', 1472),
+      bundle_timetag=self.endpoint_delay(settings, 'bundle_timetag'),
+      coalesce=self.endpoint_delay(settings, 'coalesce'),
+      coalesce_addresses=settings.get('coalesce_addresses'),
+      queue=settings.get('queue', 0),
+      overflow=settings.get('overflow', "drop-oldest"),
+      rate=settings.get('rate', 0))
+
+  def index_scenes(self, config):
+    # Lazy mode: only what routing and the GUI need up front
+    config.lazy_scenes = LazyScenes(self, config, self.lazy_limit)
+    config.scene_map = LazySceneView(config.lazy_scenes, 0)
+    config.scene_plans = LazySceneView(config.lazy_scenes, 1)
+    for scene in config.raw['scenes']:
+      config.scene_names[scene['key']] = scene['name']
+      if 'midi' in scene:
+        config.midi_map[scene['midi']] = scene['key']
+
+  def scene_messages(self, scene, mapping, warnings = None):
+    # Configuration warnings for the scene are added to warnings, if given
+    arr = []
+
+    self.warnings = warnings
+    try:
+      for key, value in scene.items():
+        if not (key == "key" or key == "name" or key == "midi"):
+          self.get_commands(key, value, mapping[key], arr)
+    finally:
+      self.warnings = None
+
+    if debug:
+      print("Array generated for scene " + scene['name'] + ":")
+      print(arr)
+      print()
+
+    return arr
+
+  def compile_scene(self, scene, mapping, config):
+    warnings = []
+    arr = self.scene_messages(scene, mapping, warnings)
+    if len(warnings) > 0:
+      config.scene_warnings[scene['key']] = warnings
+
+    if 'midi' in scene:
+      config.midi_map[scene['midi']] = scene['key']
+
+    config.scene_map[scene['key']] = arr
+    config.scene_plans[scene['key']] = self.compile_plan(scene['key'], arr, config.endpoints)
+    config.scene_names[scene['key']] = scene['name']
+
+  def compile_plan(self, key, messages, endpoints):
+    buckets = {}
+    bundled = {}
+    for message in messages:
+      if message.prefix not in endpoints:
+        event_log.warning("\nConfiguration Warning - Prefix not recognized in scene \"{0}\": {1}".format(key, message.prefix))
+        continue
+      endpoint = endpoints[message.prefix]
+      bucket = buckets.setdefault(message.delay, [])
+      if endpoint.bundle:
+        # Collect this endpoint's messages for the delay, packed below
+        if (message.delay, endpoint.prefix) not in bundled:
+          bundled[(message.delay, endpoint.prefix)] = []
+          bucket.append(endpoint)
+        bundled[(message.delay, endpoint.prefix)].append(message)
+      else:
+        bucket.append(PlanPacket(endpoint, message.dgram, (message,)))
+
+    plan = []
+    for delay in sorted(buckets):
+      packets = []
+      for item in buckets[delay]:
+        if isinstance(item, Endpoint):
+          for bundle in split_bundles(bundled[(delay, item.prefix)], item.mtu):
+            packets.append(PlanPacket(item, build_bundle(bundle), tuple(bundle)))
+        else:
+          packets.append(item)
+      batches, unbatched = self.compile_batches(packets)
+      plan.append(PlanBucket(delay, tuple(packets), batches, unbatched))
+
+    return ScenePlan(key, tuple(plan))
+
+  def compile_batches(self, packets):
+    # Group the packets for each set of connected sockets into one SendBatch,
+    # which fan-out endpoints send on every socket.  Queued endpoints and
+    # bundles stamped at send time can't be prebuilt.
+    if SendBatch is None or len(packets) < SEND_BATCH_MIN:
+      return (), tuple(packets)
+    groups = {}
+    for packet in packets:
+      endpoint = packet.endpoint
+      if (all(pooled.connected for pooled in endpoint.pooled_sockets)
+          and not endpoint.queue and not (endpoint.bundle and endpoint.bundle_timetag)):
+        groups.setdefault(tuple(endpoint.pooled_sockets), []).append(packet)
+    batches = []
+    batched = set()
+    for sockets, group in groups.items():
+      if len(group) >= SEND_BATCH_MIN:
+        batches.append(PlanBatch(group[0].endpoint, sockets, tuple(packet.dgram for packet in group)))
+        batched.update(id(packet) for packet in group)
+    return tuple(batches), tuple(packet for packet in packets if id(packet) not in batched)
 
   def is_osc_command(self, item):
     return isinstance(item, str) and item.startswith("/") and len(item.split("/")) > 1
 
+  def shared_message(self, command, delay):
+    # Scenes sending the same command with the same delay share one
+    # message, so it is parsed and encoded once.  Not with --lazy: the
+    # table would keep every message ever compiled alive past the LRU cap,
+    # which counts and frees each scene's messages as its own.
+    if self.lazy:
+      return OSCMessage(command, delay=delay)
+    message = self.shared_messages.get((command, delay))
+    if message is None:
+      message = self.shared_messages[(command, delay)] = OSCMessage(command, delay=delay)
+    return message
+
+  def config_warning(self, text):
+    event_log.warning(text)
+    if self.warnings is not None:
+      self.warnings.append(text)
+
+  def replay_warnings(self, config):
+    # Scenes read from the compiled cache aren't compiled again, so show
+    # the warnings from when they were, each one once
+    shown = set()
+    for warnings in config.scene_warnings.values():
+      for text in warnings:
+        if text not in shown:
+          shown.add(text)
+          event_log.warning(text + " (from when this file was compiled)")
+
+  def list_entries(self, key, map_value):
+    # The checked in and out commands of a list-notation map, worked out
+    # the first time a scene uses it.  A command that is missing or isn't
+    # an OSC command is reported once here and left out of every scene.
+    cached = self.list_maps.get(id(map_value))
+    if cached is not None and cached[0] is map_value:
+      return cached[1]
+    entries = []
+    for map_key, map_val in map_value.items():
+      commands = []
+      for direction in ("in", "out"):
+        command = map_val.get(direction) if isinstance(map_val, dict) else None
+        if not self.is_osc_command(command):
+          self.config_warning("\nConfiguration Warning - List item \"{0}\" under \"{1}\" has no valid \"{2}\" command: \"{3}\"".format(map_key, key, direction, map_val))
+          command = None
+        commands.append(command)
+      entries.append((map_key, commands[0], commands[1]))
+    # The map itself is kept with its entries so its id can't be reused
+    self.list_maps[id(map_value)] = (map_value, entries)
+    return entries
+
   def get_commands(self, key, value, map_value, array):
 
     def print_error(key, value, map_value):
       print("Could not process item with key ", key, ", value:", value, ", and map value:", map_value)
-      log_data.append("\nConfiguration Warning - Could not process item with key \"" + key + "\", value: \"" + str(value) + "\", and map value: \"" + str(map_value) + "\"")
+      self.config_warning("\nConfiguration Warning - Could not process item with key \"" + key + "\", value: \"" + str(value) + "\", and map value: \"" + str(map_value) + "\"")
 
     if debug:
       print("Getting commands for key:", key, "and value:", value, "\nUsing map_value:", map_value)
@@ -200,31 +1570,36 @@ class SceneParser():
         self.get_commands(_key, _value, map_value[_key], array)
 
     elif isinstance(value, list):
+      # One pass over the list for the delay and the selected items, then
+      # one over the map, so long lists cost linear time
       delay = 0
+      selected = set()
       for item in value:
-        if 'delay' in item:
-          delay = int(item.split(" ")[1].replace("s", ""))
-
-      for map_key, map_val in map_value.items():
-        if map_key in value and map_key != "none":
-          if map_key in map_value and 'in' in map_value[map_key] and self.is_osc_command(map_value[map_key]['in']):
-            array.append(OSCMessage(map_value[map_key]['in'], delay=delay))
-          else:
-            print_error(key, value, map_value)
-        else:
-          if map_key in map_value and 'out' in map_value[map_key] and self.is_osc_command(map_value[map_key]['out']):
-            array.append(OSCMessage(map_value[map_key]['out'], delay=delay))
-          else:
+        if isinstance(item, str) and item.startswith("delay "):
+          delay = parse_delay(item[6:])
+          if delay is None:
             print_error(key, value, map_value)
+            delay = 0
+        elif not isinstance(item, (dict, list)):
+          selected.add(item)
+      selected.discard("none")
+
+      for map_key, command_in, command_out in self.list_entries(key, map_value):
+        command = command_in if map_key in selected else command_out
+        if command is not None:
+          array.append(self.shared_message(command, delay))
 
     elif isinstance(value, str):
       string = value.split(" ")[0]
       delay = 0
       if len(value.split(" ")) > 1:
-        delay = int(value.split(" ")[1].replace("s", ""))
+        delay = parse_delay(value.split(" ")[1])
+        if delay is None:
+          print_error(key, value, map_value)
+          delay = 0
 
       if string in map_value and self.is_osc_command(map_value[string]):
-        array.append(OSCMessage(map_value[string], delay=delay))
+        array.append(self.shared_message(map_value[string], delay))
       else:
         print_error(key, value, map_value)
 
@@ -234,60 +1609,349 @@ class SceneParser():
     else:
       print_error(key, value, map_value)
     
+  def getConfig(self):
+    return self.config
+
   def getSceneMap(self):
-    return self.scene_map
+    return self.config.scene_map
+
+  def getScenePlans(self):
+    return self.config.scene_plans
 
   def getSceneNames(self):
-    return self.scene_names
+    return self.config.scene_names
 
   def getMidiMap(self):
-    return self.midi_map
+    return self.config.midi_map
+
+  def getEndpoints(self):
+    return self.config.endpoints
+
+  def getForwardTable(self):
+    return self.config.forward_table
 
   def getUdpClients(self):
-    return self.udp_clients
+    return self.config.udp_clients
 
   def getUdpClientStrings(self):
-    return self.udp_client_strings
+    return self.config.udp_client_strings
 
   def isLoaded(self):
     return self.loaded
 
 
+### Watch the scenes file and call back when it changes
+
+class ConfigWatcher:
+  def __init__(self, filename, callback, interval = 1.0):
+    self.filename = filename
+    self.callback = callback
+    self.interval = interval
+    self.running = True
+    self.last_stat = self._stat()
+    self.thread = Thread(target=self._run, name="OSCConfigWatcher", daemon=True)
+    self.thread.start()
+
+  def _stat(self):
+    try:
+      stat = os.stat(self.filename)
+      return (stat.st_mtime, stat.st_size)
+    except OSError:
+      return None
+
+  def _run(self):
+    while self.running:
+      time.sleep(self.interval)
+      current = self._stat()
+      if current is not None and current != self.last_stat:
+        self.last_stat = current
+        try:
+          self.callback(self.filename)
+        except Exception as e:
+          event_log.warning("\nCould not reload configuration from file {0}: {1}".format(self.filename, e))
+
+  def stop(self):
+    self.running = False
+
+### Capture files of received packets
+#
+# An 8 byte magic header, then one record per datagram: the seconds since
+# recording started as a float64, the length as a uint32, and the bytes.
+
+CAPTURE_MAGIC = b"OSCCAP1\x00"
+CAPTURE_RECORD = struct.Struct("<dI")
+
+class CaptureWriter:
+  def __init__(self, filename):
+    self.file = open(filename, 'wb')
+    self.file.write(CAPTURE_MAGIC)
+    self.lock = Lock()
+    self.start = time.perf_counter()
+    self.count = 0
+
+  def write(self, data):
+    offset = time.perf_counter() - self.start
+    with self.lock:
+      if self.file is not None:
+        self.file.write(CAPTURE_RECORD.pack(offset, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+  def close(self):
+    with self.lock:
+      if self.file is not None:
+        self.file.close()
+        self.file = None
+
+def read_capture(filename):
+  # Yields (offset, datagram) for every record in a capture file
+  with open(filename, 'rb') as capture_file:
+    if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+      raise ValueError("{0} is not an OSC capture file".format(filename))
+    while True:
+      header = capture_file.read(CAPTURE_RECORD.size)
+      if len(header) < CAPTURE_RECORD.size:
+        return
+      offset, length = CAPTURE_RECORD.unpack(header)
+      data = capture_file.read(length)
+      if len(data) < length:
+        return
+      yield offset, data
+
+### OSC server that can forward pass-through packets without decoding them
+
+class RoutingOSCUDPServer(socketserver.UDPServer):
+  def __init__(self, server_address, controller):
+    # Set before the base class binds the socket in its constructor
+    self.reuse_port = controller.reuse_port
+    super().__init__(server_address, None)
+    self.controller = controller
+
+  def server_bind(self):
+    if self.reuse_port:
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    super().server_bind()
+
+  def finish_request(self, request, client_address):
+    # Routing goes through the controller's index rather than a dispatcher,
+    # so the server follows reloads of the scenes file without a restart
+    self.controller.handle_datagram(request[0])
+
+### asyncio engine: receives with a datagram protocol, sends through
+# non-blocking transports and schedules delays with loop.call_later
+#
+# asyncio is only imported when this engine starts, so the protocols
+# implement asyncio.DatagramProtocol's methods instead of subclassing it.
+
+class _DatagramProtocol:
+  def connection_made(self, transport):
+    pass
+
+  def connection_lost(self, exc):
+    pass
+
+  def pause_writing(self):
+    pass
+
+  def resume_writing(self):
+    pass
+
+  def datagram_received(self, data, addr):
+    pass
+
+  def error_received(self, exc):
+    pass
+
+class _OSCReceiveProtocol(_DatagramProtocol):
+  def __init__(self, controller):
+    self.controller = controller
+
+  def datagram_received(self, data, addr):
+    self.controller.handle_datagram(data)
+
+  def error_received(self, exc):
+    event_log.warning("Receive error: {0}".format(exc))
+
+class _OSCSendProtocol(_DatagramProtocol):
+  def __init__(self, address):
+    self.address = address
+
+  def error_received(self, exc):
+    event_log.warning("Error sending to {0}:{1}: {2}".format(self.address[0], self.address[1], exc))
+
+class AsyncIOEngine:
+  # A destination whose transport can't be opened is retried after this
+  # many seconds, doubling up to RETRY_MAX; packets for it are dropped
+  # meanwhile.  Up to WAITING_MAX packets wait for a transport being opened.
+  RETRY_MIN = 1.0
+  RETRY_MAX = 30.0
+  WAITING_MAX = 1000
+
+  def __init__(self, controller):
+    self.controller = controller
+    self.loop = None
+    self.thread = None
+    self.server_transport = None
+    self.transports = {}
+    self.opening = set()
+    self.waiting = {}
+    self.retry = {}
+    self.pending = 0
+
+  def start(self, input_port):
+    import asyncio
+    self.loop = asyncio.new_event_loop()
+    self.thread = Thread(target=self._run, name="OSCAsyncIO", daemon=True)
+    self.thread.start()
+    try:
+      asyncio.run_coroutine_threadsafe(self._listen(input_port), self.loop).result()
+    except:
+      self.stop()
+      raise
+
+  def _run(self):
+    import asyncio
+    asyncio.set_event_loop(self.loop)
+    self.loop.run_forever()
+    self.loop.close()
+
+  async def _listen(self, input_port):
+    self.server_transport, _ = await self.loop.create_datagram_endpoint(lambda: _OSCReceiveProtocol(self.controller), local_addr=("0.0.0.0", input_port), reuse_port=self.controller.reuse_port or None)
+    for endpoint in list(self.controller.parser.getEndpoints().values()) + [self.controller.output_endpoint]:
+      if endpoint is not None:
+        for pooled in endpoint.pooled_sockets:
+          if pooled.key not in self.transports and pooled.key not in self.opening:
+            self.opening.add(pooled.key)
+            await self._open(pooled.key)
+
+  async def _open(self, key):
+    # Transports are keyed like the socket pool, and get a socket of their
+    # own opened the same way, so multicast options apply to them too.  The
+    # lookup and connect() run off the loop, which never waits on them.
+    sock = None
+    try:
+      pooled = await self.loop.run_in_executor(None, socket_pool.open, key)
+      sock = pooled.sock
+      if not pooled.connected:
+        await self.loop.run_in_executor(None, sock.connect, pooled.sockaddr)
+      sock.setblocking(False)
+      transport, _ = await self.loop.create_datagram_endpoint(lambda: _OSCSendProtocol(key), sock=sock)
+      self.transports[key] = transport
+      self.retry.pop(key, None)
+      for _, dgram in self.waiting.pop(key, ()):
+        transport.sendto(dgram)
+    except OSError as e:
+      if sock is not None:
+        sock.close()
+      _, backoff = self.retry.get(key, (0, self.RETRY_MIN / 2))
+      backoff = min(backoff * 2, self.RETRY_MAX)
+      self.retry[key] = (self.loop.time() + backoff, backoff)
+      for endpoint, _ in self.waiting.pop(key, ()):
+        self.controller.metrics.count("send_errors", str(endpoint))
+      event_log.warning("Could not open transport to {0}:{1}, retrying in {2:g}s: {3}".format(key[0], key[1], backoff, e))
+    finally:
+      self.opening.discard(key)
+
+  def send(self, endpoint, dgram):
+    for pooled in endpoint.pooled_sockets:
+      key = pooled.key
+      transport = self.transports.get(key)
+      if transport is not None:
+        transport.sendto(dgram)
+        continue
+      retry = self.retry.get(key)
+      if retry is not None and self.loop.time() < retry[0]:
+        # Still backing off from a failed open
+        self.controller.metrics.count("send_errors", str(endpoint))
+        continue
+      waiting = self.waiting.setdefault(key, [])
+      if len(waiting) < self.WAITING_MAX:
+        waiting.append((endpoint, dgram))
+      else:
+        self.controller.metrics.count("send_errors", str(endpoint))
+      if key not in self.opening:
+        self.opening.add(key)
+        self.loop.create_task(self._open(key))
+
+  def call_later(self, delay, callback, *args):
+    self.pending += 1
+    return self.loop.call_later(delay, self._run_later, callback, args)
+
+  def call_at(self, deadline, callback, *args):
+    # The deadline is on time.monotonic(), which the loop's clock need not be
+    return self.call_later(max(0, deadline - time.monotonic()), callback, *args)
+
+  def _run_later(self, callback, args):
+    self.pending -= 1
+    callback(*args)
+
+  def stop(self):
+    def shutdown():
+      if self.server_transport is not None:
+        self.server_transport.close()
+      for transport in self.transports.values():
+        transport.close()
+      self.loop.stop()
+
+    if self.loop is not None and self.thread is not None:
+      self.loop.call_soon_threadsafe(shutdown)
+      self.thread.join()
+    self.server_transport = None
+    self.transports = {}
+    self.opening = set()
+    self.waiting = {}
+    self.retry = {}
+    self.loop = None
+    self.thread = None
+
 class OSCSceneController():
   def __init__(self, parser):
     self.parser = parser
     self.server_thread = None
     self.server = None
+    self.engine = None
+    self.engine_name = "thread"
+    self.scene_state = None
+    self.scene_lock = Lock()
     self.last_scene = None
     self.running = False
-    self.output_client = None
+    self.input_port = None
+    self.reuse_port = False
+    self.raw_routing = False
+    self.track_state = False
+    self.sent_state = {}
+    self.output_endpoint = None
+    self.recorder = None
+    self.scheduler = Scheduler()
+    self.coalescer = Coalescer(self)
+    self.send_queues = {}
+    self.send_queues_lock = Lock()
+    self.metrics = Metrics()
+    self.metrics.gauge("scheduled_sends", lambda: len(self.scheduler) + (self.engine.pending if self.engine is not None else 0))
+    self.metrics.gauge("open_sockets", lambda: len(socket_pool))
 
   def start(self, input_port):
     if self.running:
       self.stop()
 
     if not self.parser.isLoaded():
-      log_data.append("No configuration loaded, once you load a configuration the server will start")
+      event_log.info("No configuration loaded, once you load a configuration the server will start")
       return
 
-    for key, string in self.parser.getUdpClientStrings().items():
-      if string.split(":")[1] == str(input_port):
-        log_data.append("Cannot start server because the input port {0} is the same as the the output port for prefix '{1}'.  Please change the input port.".format(input_port, key))
-        return
+    if not self.check_input_port(input_port, "start server"):
+      return
 
     try:
-      dispatch = dispatcher.Dispatcher()
-      for key in self.parser.getSceneMap():
-        dispatch.map("/scene/" + key, self.respond_to_scene)
-      for number in self.parser.getMidiMap():
-        dispatch.map("/midi-scene/" + str(round(number / 127, 2)), self.respond_to_scene)
-      dispatch.set_default_handler(self.route_message)
-
-      self.server = osc_server.BlockingOSCUDPServer(("0.0.0.0", input_port), dispatch)
-      self.server_thread = Thread(target=self.server.serve_forever)
-      self.server_thread.start()
-      log_data.append("\nServer started, listening on all interfaces on port {0}...\n".format(input_port))
+      if self.engine_name == "asyncio":
+        self.engine = AsyncIOEngine(self)
+        self.engine.start(input_port)
+      else:
+        self.server = RoutingOSCUDPServer(("0.0.0.0", input_port), self)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+      event_log.info("\nServer started, listening on all interfaces on port {0}...\n".format(input_port))
       self.running = True
+      self.input_port = input_port
 
     except KeyboardInterrupt:
       print("Exiting...")
@@ -301,73 +1965,260 @@ class OSCSceneController():
       if self.server_thread is not None:
         self.server_thread.join()
         self.server_thread = None
+      if self.engine is not None:
+        self.engine.stop()
+        self.engine = None
+    with self.send_queues_lock:
+      for queue in self.send_queues.values():
+        queue.close()
+      self.send_queues = {}
     self.running = False
-    log_data.append("\nServer stopped\n")
+    event_log.info("\nServer stopped\n")
 
   def isRunning(self):
     return self.running
 
-  def route_message(self, addr, *args):
-    self.send_msg(OSCMessage(addr, args))
+  def check_input_port(self, input_port, action):
+    # Sending to our own input port would route every packet back in
+    for key, endpoint in self.parser.getEndpoints().items():
+      if any(port == input_port for _, port in endpoint.destinations):
+        event_log.warning("Cannot {0} because the input port {1} is the same as the the output port for prefix '{2}'.  Please change the input port.".format(action, input_port, key))
+        return False
+    return True
 
-  def respond_to_scene(self, addr, args = 1):
-    scene_map = self.parser.getSceneMap()
-    midi_map = self.parser.getMidiMap()
-    scene_names = self.parser.getSceneNames()
-    new_scene = ""
-
-    if addr.split("/")[1] == "scene":
-      new_scene = addr.split("/")[2]
-    elif addr.split("/")[1] == "midi-scene":
-      new_scene = midi_map[int(round(float(addr.split("/")[2]) * 127))]
+  def check_loaded_config(self):
+    # A configuration loaded into a running server gets the check start()
+    # does, and the server stops rather than route to itself
+    if self.running and not self.check_input_port(self.input_port, "keep the server running"):
+      self.stop()
+
+  @property
+  def last_scene(self):
+    if self.scene_state is not None:
+      return self.scene_state.get()
+    return self._last_scene
+
+  @last_scene.setter
+  def last_scene(self, key):
+    if self.scene_state is not None:
+      self.scene_state.set(key)
+    else:
+      self._last_scene = key
+
+  def share_scene_state(self, scene_state):
+    # Keep the current scene in memory shared with the other workers
+    self.scene_state = scene_state
+    self.scene_lock = scene_state.lock
+    self.reuse_port = True
+
+  def handle_datagram(self, data):
+    start = time.perf_counter()
+    self.metrics.count("packets_received")
+    if self.recorder is not None:
+      self.recorder.write(data)
+    if not (self.raw_routing and self.forward_raw(data)):
+      try:
+        packet = osc_packet.OscPacket(data)
+        for timed_msg in packet.messages:
+          # Bundles stamped for later are held until their time comes
+          wait = timed_msg.time - time.time() if timed_msg.time else 0
+          if wait > 0:
+            self.schedule(wait, self.dispatch, timed_msg.message.address, timed_msg.message.params)
+          else:
+            self.dispatch(timed_msg.message.address, timed_msg.message.params)
+      except osc_packet.ParseError:
+        pass
+    self.metrics.observe("handler_seconds", time.perf_counter() - start)
+
+  def dispatch(self, address, args):
+    config = self.parser.getConfig()
+    key = config.index.resolve_scene(address)
+    if key is not None:
+      self.change_scene(config, key, address, *args[:1])
+    elif address == "/scene-resend":
+      self.resend_scene(address, *args)
     else:
-      log_data.append("\nReceived invalid message: {0}".format(addr))
+      self.route_message(address, *args)
+
+  def transmit(self, endpoint, dgram):
+    if endpoint.queue:
+      queue = self.send_queues.get(endpoint)
+      if queue is None:
+        queue = self.open_send_queue(endpoint)
+      queue.put(dgram)
       return
+    try:
+      if self.engine is not None:
+        self.engine.send(endpoint, dgram)
+      else:
+        endpoint.send(dgram)
+    except OSError as e:
+      self.send_failed(endpoint, e)
+
+  def transmit_batch(self, plan_batch):
+    for pooled in plan_batch.sockets:
+      try:
+        plan_batch.batch.send(pooled.sock)
+      except OSError as e:
+        self.send_failed(plan_batch.endpoint, e)
+
+  def send_failed(self, endpoint, error):
+    self.metrics.count("send_errors", str(endpoint))
+    event_log.warning("Error sending to {0}: {1}".format(endpoint, error))
+
+  def open_send_queue(self, endpoint):
+    # Endpoints are replaced when a reload changes their settings, so this
+    # is also where queues of endpoints that are gone get closed
+    with self.send_queues_lock:
+      if endpoint in self.send_queues:
+        return self.send_queues[endpoint]
+      current = set(self.parser.getEndpoints().values())
+      queues = { old: queue for old, queue in self.send_queues.items() if old in current }
+      for old, queue in self.send_queues.items():
+        if old not in current:
+          queue.close()
+      queues[endpoint] = SendQueue(endpoint, self)
+      self.send_queues = queues
+      return queues[endpoint]
+
+  def schedule(self, delay, callback, *args):
+    if self.engine is not None:
+      return self.engine.call_later(delay, callback, *args)
+    return self.scheduler.schedule(delay, callback, *args)
+
+  def schedule_at(self, deadline, callback, *args):
+    if self.engine is not None:
+      return self.engine.call_at(deadline, callback, *args)
+    return self.scheduler.schedule_at(deadline, callback, *args)
 
-    if new_scene not in scene_map:
-      log_data.append("\nReceived undefined scene '{0}'".format(new_scene))
+  def route_message(self, addr, *args):
+    message = OSCMessage(addr, args)
+    endpoint = self.parser.getEndpoints().get(message.prefix)
+    if endpoint is not None and endpoint.coalesces(addr):
+      self.metrics.count("packets_routed", message.prefix)
+      if not self.coalescer.hold(endpoint, addr, message.dgram):
+        self.send_coalesced(endpoint, addr, message.dgram)
       return
+    if self.send_msg(message) is not False:
+      self.metrics.count("packets_routed", message.prefix)
+
+  def send_coalesced(self, endpoint, address, dgram):
+    self.transmit(endpoint, dgram)
+    if self.track_state:
+      self.sent_state[(endpoint.address, address)] = dgram
+    event_log.add(DEBUG, "forward", dgram, destination=endpoint)
+
+  def forward_raw(self, data):
+    # Read the prefix straight out of the datagram's address string and send
+    # the original bytes on.  Bundles, scene triggers and unknown prefixes
+    # return False and are parsed and dispatched as usual.
+    if data[:1] != b"/":
+      return False
+    end = data.find(b"\x00")
+    if end == -1:
+      return False
+    slash = data.find(b"/", 1, end)
+    endpoint = self.parser.getForwardTable().get(data[1:slash if slash != -1 else end])
+    if endpoint is None:
+      return False
+    if endpoint.coalesce and self.coalescer_holds(endpoint, data, end):
+      return True
+    self.transmit(endpoint, data)
+    if self.track_state:
+      self.sent_state[(endpoint.address, data[:end].decode(errors="replace"))] = data
+    self.metrics.count("packets_routed", endpoint.prefix)
+    event_log.add(DEBUG, "forward", data, destination=endpoint)
+    return True
+
+  def coalescer_holds(self, endpoint, data, end):
+    address = data[:end].decode(errors="replace")
+    if not endpoint.coalesces(address):
+      return False
+    self.metrics.count("packets_routed", endpoint.prefix)
+    if not self.coalescer.hold(endpoint, address, data):
+      self.send_coalesced(endpoint, address, data)
+    return True
+
+  def respond_to_scene(self, addr, args = 1):
+    config = self.parser.getConfig()
+    new_scene = config.index.resolve_scene(addr)
+
+    if new_scene is None:
+      if addr.startswith("/scene/") or addr.startswith("/midi-scene/"):
+        event_log.warning("\nReceived undefined scene '{0}'".format(addr.split("/")[2]))
+      else:
+        event_log.warning("\nReceived invalid message: {0}".format(addr))
+      return
+
+    self.change_scene(config, new_scene, addr, args)
+
+  def change_scene(self, config, new_scene, addr, args = 1):
+    # Everything is read from the one config passed in, even if a reload
+    # swaps the parser's config meanwhile.  The lock makes workers agree
+    # on the last scene; only the scene's own messages go out after it.
+    # With --lazy the plan is compiled here, before any state changes, so a
+    # scene that fails to compile is never shown as selected.
+    plan = None
+    if not (args == 0 or args == 0.0):
+      plan = config.scene_plans.get(new_scene)
+      if plan is None:
+        return
+    with self.scene_lock:
+      if not self.select_scene(config, new_scene, addr, args):
+        return
+
+    ### Finally we need to actual send the OSC messages that make up the scene change
+    self.fire_plan(plan)
+
+  def select_scene(self, config, new_scene, addr, args):
+    scene_names = config.scene_names
 
     # If we are recieving one of the turn off signals that
     # we are sending, ignore it (prevent feedback loop)
     if args == 0 or args == 0.0:
       if new_scene != self.last_scene:
-        self.send_msg(OSCMessage("/scene/" + new_scene, [0.0]))
-        self.send_msg(OSCMessage("/scene/" + new_scene, [0]))
+        feedback = config.feedback[new_scene]
+        self.send_msg(feedback.off_float)
+        self.send_msg(feedback.off)
       return
 
     # If we are trying to select the same scene, resend confirmation message but don't process again
     if new_scene == self.last_scene:
-      if self.output_client is not None:
-        self.send_msg(OSCMessage("/scene/" + new_scene + " 1"))
+      if self.output_endpoint is not None:
+        self.send_msg(config.feedback[new_scene].on)
       return
 
-    log_data.append("")
-    log_data.append("Received: " + addr + " " + str(args))
+    event_log.info("")
+    event_log.add(INFO, "receive", addr, args)
+    self.metrics.count("scene_triggers", new_scene)
 
 
     # Only send outgoing messages if we know where to send them to
-    if self.output_client is not None:
+    if self.output_endpoint is not None:
 
       ### First we need to send message to turn on the new scene
-      self.send_msg(OSCMessage("/scene/" + new_scene + " 1"))
+      self.send_msg(config.feedback[new_scene].on)
 
 
       ### Then we need to send message to turn off current scene
 
       # If we know what the last scene is, deselect it
       if self.last_scene is not None:
-        self.send_msg(OSCMessage("/scene/" + self.last_scene, 0))
-        self.send_msg(OSCMessage("/scene/" + self.last_scene, 0.0))
+        # The last scene may be gone from the file since a reload
+        feedback = config.feedback.get(self.last_scene) or scene_feedback(self.last_scene)
+        self.send_msg(feedback.off)
+        self.send_msg(feedback.off_float)
 
       # If we don't know what the last scene is, turn them all off
       #   except for the current scene
       else:
+        # Each scene's prebuilt feedback messages are scheduled as they
+        # are, with the delay bypassed when they come due
         delay = 10
-        for key in scene_map:
+        for key, feedback in config.feedback.items():
           if key != new_scene:
-            self.send_msg(OSCMessage("/scene/" + key, 0, delay=(delay/100)), quiet = True)
-            self.send_msg(OSCMessage("/scene/" + key, 0.0, delay=(delay/100)), quiet = True)
+            self.schedule(delay/100, self.send_msg, feedback.off, True, True)
+            self.schedule(delay/100, self.send_msg, feedback.off_float, True, True)
             delay += 5
           
     self.last_scene = new_scene
@@ -375,48 +2226,159 @@ class OSCSceneController():
     # Update GUI
     global active_scene
     active_scene = scene_names[new_scene]
+    event_log.wake()
+    return True
+
+  def fire_plan(self, plan):
+    # Every delay is an offset from this one instant rather than from when
+    # its own bucket got scheduled, so the cues of a scene cannot drift apart
+    start = time.monotonic()
+    for bucket in plan.buckets:
+      if bucket.delay == 0:
+        self.send_bucket(bucket)
+      else:
+        event_log.debug("Scheduling {0} messages to be sent after {1} seconds".format(sum(len(packet.messages) for packet in bucket.packets), bucket.delay))
+        self.schedule_at(start + bucket.delay, self.send_cue, bucket, start + bucket.delay)
+
+  def send_cue(self, bucket, deadline):
+    self.metrics.observe("cue_jitter_seconds", abs(time.monotonic() - deadline))
+    self.send_bucket(bucket)
+
+  def resend_scene(self, addr, *args):
+    # Forget what we think the endpoints are showing and send the whole
+    # current scene again, for when the state has drifted
+    self.sent_state = {}
+    config = self.parser.getConfig()
+    plan = config.scene_plans.get(self.last_scene)
+    if plan is not None:
+      event_log.info("\nResending every message for scene '{0}'".format(self.last_scene))
+      self.fire_plan(plan)
+
+  def changed_packets(self, packets):
+    state = self.sent_state
+    changed = []
+    skipped = 0
+    for packet in packets:
+      if not packet.endpoint.track_state:
+        changed.append(packet)
+        continue
+      address = packet.endpoint.address
+      fresh = []
+      for message in packet.messages:
+        key = (address, message.address)
+        if state.get(key) != message.dgram:
+          state[key] = message.dgram
+          fresh.append(message)
+      skipped += len(packet.messages) - len(fresh)
+      if len(fresh) == len(packet.messages):
+        changed.append(packet)
+      elif len(fresh) > 0:
+        # Repack a bundle with only the messages that still need sending
+        dgram = build_bundle(fresh) if packet.endpoint.bundle else fresh[0].dgram
+        changed.append(PlanPacket(packet.endpoint, dgram, tuple(fresh)))
+    if skipped > 0:
+      self.metrics.count("messages_skipped", amount = skipped)
+    return changed
+
+  def send_bucket(self, bucket):
+    # The prebuilt batches only hold when every packet goes out unchanged
+    # on the endpoint sockets
+    if len(bucket.batches) == 0 or self.track_state or self.engine is not None:
+      self.send_packets(bucket.packets)
+      return
+    self.discard_coalesced(bucket.packets)
+    for plan_batch in bucket.batches:
+      self.transmit_batch(plan_batch)
+    for packet in bucket.unbatched:
+      self.transmit_packet(packet)
+    self.log_packets(bucket.packets)
+
+  def send_packets(self, packets):
+    if self.track_state:
+      packets = self.changed_packets(packets)
+    self.discard_coalesced(packets)
+    for packet in packets:
+      self.transmit_packet(packet)
+    self.log_packets(packets)
+
+  def transmit_packet(self, packet):
+    if packet.endpoint.bundle_timetag and packet.endpoint.bundle:
+      self.transmit(packet.endpoint, stamp_bundle(packet.dgram, packet.endpoint.bundle_timetag))
+    else:
+      self.transmit(packet.endpoint, packet.dgram)
 
-    ### Finally we need to actual send the OSC messages that make up the scene change
-    for osc_command in scene_map[new_scene]:
-      self.send_msg(osc_command)
+  def discard_coalesced(self, packets):
+    for packet in packets:
+      if packet.endpoint.coalesce:
+        for message in packet.messages:
+          self.coalescer.discard(packet.endpoint, message.address)
 
+  def log_packets(self, packets):
+    for packet in packets:
+      for message in packet.messages:
+        event_log.add(DEBUG, "send", message.address, message.arguments, packet.endpoint)
 
   def send_msg(self, message, delay_bypass = False, quiet = False):
     if message.delay == 0 or delay_bypass:
       if message.prefix == "scene":
-        if self.output_client is not None:
-          self.output_client.send_message(message.address, message.arguments)
-      elif message.prefix in self.parser.getUdpClients():
-        self.parser.getUdpClients()[message.prefix].send_message(message.address, message.arguments)
+        endpoint = self.output_endpoint
+        if endpoint is None:
+          return
       else:
-        log_data.append("Prefix not recognized: {0}".format(message.prefix))
+        endpoint = self.parser.getEndpoints().get(message.prefix)
+        if endpoint is None:
+          # One series for all of them, as anyone on the network can make
+          # up new prefixes
+          self.metrics.count("packets_dropped", "unknown")
+          event_log.warning("Prefix not recognized: {0}".format(message.prefix))
+          return False
+      self.transmit(endpoint, message.dgram)
+      if self.track_state and endpoint is not self.output_endpoint:
+        self.sent_state[(endpoint.address, message.address)] = message.dgram
       if not quiet:
-        log_data.append("Sending \"" + message.address + " " + " ".join([str(s) for s in message.arguments]) + "\" to " + self.parser.getUdpClientStrings()[message.prefix])
+        event_log.add(DEBUG, "send", message.address, message.arguments, endpoint)
 
     else:
-      wait = message.delay
       if not quiet:
-        log_data.append("Scheduling \"{0}\" to be sent after {1} seconds".format(message.address, message.delay))
-      r = Timer(wait, self.send_msg, [message, True, quiet])  
-      r.start()
+        event_log.debug("Scheduling \"{0}\" to be sent after {1} seconds".format(message.address, message.delay))
+      return self.schedule(message.delay, self.send_msg, message, True, quiet)
 
   def setOutputAddress(self, ip, port):
-    self.output_client = udp_client.SimpleUDPClient(ip, port, allow_broadcast=True)
+    old = self.output_endpoint
+    self.output_endpoint = Endpoint("scene", ip, port)
+    if old is not None:
+      old.close()
 
 
 if not args.no_gui:
   class MyApp(tk.Tk):
-    def __init__(self, *args, **kwargs):
-      tk.Tk.__init__(self, *args, **kwargs)
+    # Keep the log view to this many lines, and redraw it at most this often
+    # however fast packets arrive
+    LOG_LINES = 2000
+    UPDATE_INTERVAL = 0.1
+
+    def __init__(self, args, *tk_args, **kwargs):
+      tk.Tk.__init__(self, *tk_args, **kwargs)
       self.withdraw() #hide window
 
+      self.args = args
       self.filename = None
       self.parser = SceneParser()
+      self.parser.use_cache = not args.no_cache
+      self.parser.lazy = args.lazy
+      self.parser.lazy_limit = int(args.lazy_cache_mb * 1024 * 1024)
+      self.parser.warm = args.warm
       self.controller = OSCSceneController(self.parser)
-      self.log_data_len = None
+      self.controller.raw_routing = args.raw_routing
+      self.controller.engine_name = args.engine
+      self.controller.track_state = args.track_state
+      if args.record is not None:
+        self.controller.recorder = CaptureWriter(args.record)
+      self.metrics_server = MetricsServer(self.controller.metrics, args.metrics_port) if args.metrics_port is not None else None
       self.output_port = None
       self.output_ip_address = None
       self.preferences = UserPreferences()
+      self.watcher = None
 
       self.minsize(500, 430)
       menubar = tk.Menu(self)
@@ -429,7 +2391,16 @@ if not args.no_gui:
 
       self.build()
       self.deiconify()
-      self.after(1000, self.updateGUI)
+
+      # The controller's threads wake the Tk loop through a virtual event
+      # rather than the GUI polling for changes
+      self.update_pending = False
+      self.last_update = 0
+      self.wake_event = Event()
+      self.bind('<<LogEvent>>', self.log_event_arrived)
+      Thread(target=self.wake_gui, name="GUIWaker", daemon=True).start()
+      event_log.set_listener(self.wake_event.set)
+      self.updateGUI()
 
       # Load data from preferences file
       if self.preferences.get('output_ip_address') is not None:
@@ -455,6 +2426,7 @@ if not args.no_gui:
         self.scene_file_text.set(self.filename.split("/")[-1])
         self.log("Successfully loaded configuration from file: {0}".format(self.filename))
         self.controller.start(int(self.input_port_text.get()))
+        self.watch(self.filename)
       else:
         self.log("To start, load a configuration (a YAML file with the scenes in it).")
 
@@ -463,34 +2435,86 @@ if not args.no_gui:
   #    self.destroy()
 
     def stop(self):
+      event_log.set_listener(None)
       self.controller.stop()
+      if self.watcher is not None:
+        self.watcher.stop()
+      if self.metrics_server is not None:
+        self.metrics_server.stop()
+      if self.controller.recorder is not None:
+        self.controller.recorder.close()
+
+    def wake_gui(self):
+      # Calls into Tk from another thread wait for the main loop, so they are
+      # made from this thread only; a controller thread never waits on the GUI
+      while True:
+        self.wake_event.wait()
+        self.wake_event.clear()
+        try:
+          self.event_generate('<<LogEvent>>', when='tail')
+        except RuntimeError:
+          # The main loop isn't running yet, so try again shortly
+          self.wake_event.set()
+          time.sleep(0.1)
+        except tk.TclError:
+          return # The window was destroyed
+
+    def log_event_arrived(self, event = None):
+      # Gather everything that arrives until the next redraw into one update
+      if self.update_pending:
+        return
+      self.update_pending = True
+      wait = self.last_update + self.UPDATE_INTERVAL - time.monotonic()
+      self.after(max(0, int(wait * 1000)), self.updateGUI)
 
     def updateGUI(self):
+      self.update_pending = False
+      self.last_update = time.monotonic()
 
       global active_scene
       if (active_scene is not None):
         self.active_scene_text.set(active_scene)
 
-      global log_data
-      if len(log_data) > 0:
-        log_data_store = log_data
-        log_data = []
-        self.log_text_box.configure(state='normal')
-        for item in log_data_store:
-          self.log_text_box.insert('end', item + '\n')
-        self.log_text_box.yview('end')
-        self.log_text_box.configure(state='disabled')
-
-      self.after(1000, self.updateGUI)
+      events = event_log.drain()
+      if len(events) > 0:
+        lines = [ format_event(event) for event in events[-self.LOG_LINES:] ]
+        if len(events) > self.LOG_LINES:
+          lines.insert(0, "({0} older messages not shown)".format(len(events) - self.LOG_LINES))
+        self.append_log("\n".join(lines) + "\n")
+
+    def append_log(self, text):
+      # One insert per update, then trim the oldest lines past the cap so
+      # the widget stays responsive over a long show
+      self.log_text_box.configure(state='normal')
+      self.log_text_box.insert('end', text)
+      lines = int(self.log_text_box.index('end-1c').split('.')[0])
+      if lines > self.LOG_LINES:
+        self.log_text_box.delete('1.0', '{0}.0'.format(lines - self.LOG_LINES + 1))
+      self.log_text_box.configure(state='disabled')
+      self.log_text_box.yview('end')
       
     def reload_scene_handler(self):
       self.focus()
       if (self.filename is not None):
-        self.parser.parseFromFile(self.filename)
-        self.log("Reloaded configuration from file: {0}".format(self.filename))
+        recompiled, unchanged = self.parser.reloadFromFile(self.filename)
+        self.log("Reloaded configuration from file: {0} ({1} scenes recompiled, {2} unchanged)".format(self.filename, recompiled, unchanged))
+        self.controller.check_loaded_config()
       else:
         self.log("Cannot reload, no configuration loaded")
 
+    def watch(self, filename):
+      if not self.args.watch:
+        return
+      if self.watcher is not None:
+        self.watcher.stop()
+      self.watcher = ConfigWatcher(filename, self.file_changed)
+
+    def file_changed(self, filename):
+      # Runs on the watcher thread, so report through the event log
+      recompiled, unchanged = self.parser.reloadFromFile(filename)
+      event_log.info("\nConfiguration file changed, reloaded {0} ({1} scenes recompiled, {2} unchanged)".format(filename, recompiled, unchanged))
+      self.controller.check_loaded_config()
+
     def load_from_file_handler(self):
       self.focus()
       new_filename = filedialog.askopenfilename()
@@ -499,10 +2523,15 @@ if not args.no_gui:
           messagebox.showerror("Invalid File", "Please select a Yaml configuration file with a '.yaml' extension.  Open the documentation for more information")
         else:
           self.filename = new_filename
-          self.parser.parseFromFile(new_filename)
+          self.parser.reloadFromFile(new_filename)
           self.scene_file_text.set(new_filename.split("/")[-1])
           self.log("Successfully loaded new configuration from file: {0}".format(new_filename))
-          self.controller.start(int(self.input_port_text.get()))
+          # A running server picks up the new configuration without a restart
+          if not self.controller.isRunning():
+            self.controller.start(int(self.input_port_text.get()))
+          else:
+            self.controller.check_loaded_config()
+          self.watch(new_filename)
           self.preferences.set('filename', self.filename)
 
     def isPort(self, value_if_allowed, text):
@@ -534,10 +2563,7 @@ if not args.no_gui:
         return False
 
     def log(self, text):
-      self.log_text_box.configure(state='normal')
-      self.log_text_box.insert('end', '\n' + text + '\n')
-      self.log_text_box.configure(state='disabled')
-      self.log_text_box.yview('end')
+      self.append_log('\n' + text + '\n')
 
     def input_port_changed(self, text):
       self.focus()
@@ -714,15 +2740,33 @@ if not args.no_gui:
 
 if args.no_gui:
   class CommandLineApp:
-    def __init__(self, args):
+    def __init__(self, args, scene_state = None, name = None):
 
       if args.scenes is None:
         print("Fatal Error: The --scenes argument is required")
         sys.exit(1)
         
       parser = SceneParser()
+      parser.use_cache = not args.no_cache
+      parser.lazy = args.lazy
+      parser.lazy_limit = int(args.lazy_cache_mb * 1024 * 1024)
+      # With --workers the main process warms only once they are forked, so
+      # no warming thread can hold a lock across the fork
+      parser.warm = args.warm and (args.workers <= 1 or name is not None)
       parser.parseFromFile(args.scenes)
+      self.parser = parser
+      self.args = args
+      self.name = name
+      self.watcher = None
+      self.metrics_server = None
       self.controller = OSCSceneController(parser)
+      self.controller.raw_routing = args.raw_routing
+      self.controller.engine_name = args.engine
+      self.controller.track_state = args.track_state
+      if scene_state is not None:
+        self.controller.share_scene_state(scene_state)
+      if args.record is not None:
+        self.controller.recorder = CaptureWriter(args.record)
       self.input_port = args.input_port
 
       # Load data from preferences file
@@ -739,36 +2783,147 @@ if args.no_gui:
       self.log("Successfully loaded configuration from file: {0}".format(args.scenes))
 
     def run(self):
-      port = self.input_port if args.input_port is not None else 8000
+      port = self.input_port if self.input_port is not None else 8000
       self.log("Starting OSC Server on port {}".format(port))
       self.controller.start(port)
+      # Metrics are per process, so only the main process serves them
+      if self.args.metrics_port is not None and self.name is None:
+        self.metrics_server = MetricsServer(self.controller.metrics, self.args.metrics_port)
+      if self.args.watch:
+        self.watcher = ConfigWatcher(self.args.scenes, self.file_changed)
+
+    def wait(self, stopping = None):
+      # Sleep until something is logged, the stats are due or stopping is
+      # set, instead of waking up every second to look.  Windows only
+      # delivers Ctrl-C between waits, so there it still wakes once a second.
+      wake = Event()
+      event_log.set_listener(wake.set)
+      # Anything logged before the listener was set is printed straight away
+      wake.set()
+      if stopping is not None:
+        Thread(target=lambda: (stopping.wait(), wake.set()), name="OSCStopWaiter", daemon=True).start()
+      interval = self.args.stats_interval
+      next_stats = time.monotonic() + interval
+      try:
+        while stopping is None or not stopping.is_set():
+          timeout = 1 if sys.platform == "win32" else None
+          if interval > 0:
+            timeout = min(timeout or interval, max(0, next_stats - time.monotonic()))
+          wake.wait(timeout)
+          wake.clear()
+          self.print_log()
+          if interval > 0 and time.monotonic() >= next_stats:
+            self.print_stats()
+            next_stats = time.monotonic() + interval
+      finally:
+        event_log.set_listener(None)
+
+    def start_warming(self):
+      with self.parser.load_lock:
+        self.parser.warm = self.args.warm
+        if self.parser.lazy and self.parser.warm:
+          self.parser.config.lazy_scenes.warm()
+
+    def file_changed(self, filename):
+      recompiled, unchanged = self.parser.reloadFromFile(filename)
+      event_log.info("Configuration file changed, reloaded {0} ({1} scenes recompiled, {2} unchanged)".format(filename, recompiled, unchanged))
+      self.controller.check_loaded_config()
 
     def stop(self):
       self.log("Stopping OSC Server")
+      if self.watcher is not None:
+        self.watcher.stop()
       self.controller.stop()
+      self.print_stats()
+      if self.metrics_server is not None:
+        self.metrics_server.stop()
+      if self.controller.recorder is not None:
+        self.controller.recorder.close()
+        self.log("Recorded {0} packets to {1}".format(self.controller.recorder.count, self.args.record))
+
+    def print_stats(self):
+      self.log("Metrics: " + self.controller.metrics.summary())
+
+    def print_log(self):
+      for text in [ format_event(event).strip() for event in event_log.drain() ]:
+        if len(text) > 0:
+          self.log(text)
 
     def log(self, text):
+      if self.name is not None:
+        text = "[{0}] {1}".format(self.name, text)
       print("{} - {}".format(datetime.datetime.now(), text))
 
-if __name__ == "__main__":
+  ### Extra processes listening on the same input port, for --workers
+
+  def check_workers(args):
+    if args.workers <= 1:
+      return
+    if not hasattr(socket, "SO_REUSEPORT"):
+      print("Fatal Error: --workers needs SO_REUSEPORT, which this platform does not support")
+      sys.exit(1)
+    if args.track_state:
+      # Each worker would only know about the messages it sent itself
+      print("Fatal Error: --track-state cannot be combined with --workers")
+      sys.exit(1)
+    if args.record is not None:
+      print("Fatal Error: --record cannot be combined with --workers")
+      sys.exit(1)
+
+  def run_worker(args, scene_state, stopping, number):
+    # Ctrl-C reaches every process in the group; the main process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = CommandLineApp(args, scene_state, "worker {0}".format(number))
+    app.run()
+    app.wait(stopping)
+    app.stop()
+    app.print_log()
+
+  def start_workers(args, scene_state, stopping):
+    # Forked before the main process starts any threads (it warms its
+    # scenes only afterwards), and each worker loads its own copy of the
+    # compiled scenes
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for number in range(1, args.workers):
+      worker = context.Process(target=run_worker, args=(args, scene_state, stopping, number), daemon=True)
+      worker.start()
+      workers.append(worker)
+    return workers
+
+def main(args):
+  event_log.level = LOG_LEVELS[args.log_level]
 
   if args.no_gui:
-    app = CommandLineApp(args)
+    check_workers(args)
+    workers = []
+    if args.workers > 1:
+      import multiprocessing
+      scene_state = SharedSceneState()
+      stopping = multiprocessing.Event()
+      app = CommandLineApp(args, scene_state)
+      workers = start_workers(args, scene_state, stopping)
+      app.start_warming()
+    else:
+      app = CommandLineApp(args)
+    # Stop cleanly when asked to by a service manager, as for Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     app.run()
-    interrupt = False
-    while not interrupt:
-      try:
-        time.sleep(1)
-        if len(log_data) > 0:
-          [ app.log(text.strip()) for text in log_data if len(text) > 0 ]
-          log_data = []
-      except KeyboardInterrupt:
-        interrupt = True
+    try:
+      app.wait()
+    except KeyboardInterrupt:
+      pass
+    if len(workers) > 0:
+      stopping.set()
+      for worker in workers:
+        worker.join()
     app.stop()
+    app.print_log()
 
   else:
 
-    app = MyApp()
+    app = MyApp(args)
     killer = GracefulKiller(app)
 
     # Handle MacOS quit event
@@ -778,3 +2933,6 @@ if __name__ == "__main__":
     app.title("OSC Scene Controller")
     app.mainloop()
     app.stop()
+
+if __name__ == "__main__":
+  main(args)
@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import io
+import os
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import OSCSceneController as osc
+from generate_scenes import generate_config, generate_cue_config, write_config
+
+### Benchmarks for scene compilation, scene dispatch and pass-through routing
+#
+# Everything runs in-process against UDP sink sockets on 127.0.0.1, so the
+# numbers include the real socket sends but not the network.
+
+class UDPSink:
+  def __init__(self, group = None, port = 0):
+    # With a group, the sink joins that multicast group on the loopback
+    # interface, and several sinks can share its port
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    if group is None:
+      self.sock.bind(("127.0.0.1", port))
+    else:
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.sock.bind((group, port))
+      self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton("127.0.0.1"))
+    self.sock.settimeout(0.1)
+    self.port = self.sock.getsockname()[1]
+    self.count = 0
+    self.last_time = 0
+    # Set to a list to keep (datagram, arrival time) for every datagram
+    self.arrivals = None
+    self.running = True
+    self.thread = Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while self.running:
+      try:
+        data = self.sock.recv(65535)
+      except socket.timeout:
+        continue
+      except OSError:
+        return
+      self.last_time = time.perf_counter()
+      if self.arrivals is not None:
+        self.arrivals.append((data, self.last_time))
+      self.count += 1
+
+  def close(self):
+    self.running = False
+    self.thread.join()
+    self.sock.close()
+
+class Rig:
+  def __init__(self, scene_count, **kwargs):
+    endpoint_count = kwargs.pop('endpoint_count', 2)
+    use_cache = kwargs.pop('use_cache', False)
+    generator = kwargs.pop('generator', generate_config)
+    lazy = kwargs.pop('lazy', False)
+    self.sinks = [UDPSink() for _ in range(endpoint_count)]
+    self.feedback = UDPSink()
+    config = generator(scene_count, endpoint_count, ports=[sink.port for sink in self.sinks], **kwargs)
+
+    handle, self.filename = tempfile.mkstemp(suffix=".yaml")
+    os.close(handle)
+    write_config(self.filename, config)
+
+    self.parser = osc.SceneParser()
+    self.parser.use_cache = use_cache
+    self.parser.lazy = lazy
+    self.parse_time = self.reparse()
+
+    self.controller = osc.OSCSceneController(self.parser)
+    self.controller.setOutputAddress("127.0.0.1", self.feedback.port)
+    self.keys = list(self.parser.getSceneMap().keys())
+
+  def all_sinks(self):
+    return self.sinks + [self.feedback]
+
+  def received(self):
+    return sum(sink.count for sink in self.all_sinks())
+
+  def last_time(self):
+    return max(sink.last_time for sink in self.all_sinks())
+
+  def wait_for(self, count, timeout = 2.0):
+    deadline = time.perf_counter() + timeout
+    while self.received() < count:
+      if time.perf_counter() > deadline:
+        return False
+      time.sleep(0.0001)
+    return True
+
+  def reparse(self):
+    return quiet_parse(self.parser, self.filename)
+
+  def close(self):
+    for sink in self.all_sinks():
+      sink.close()
+    if self.parser.use_cache and os.path.exists(osc.compiled_cache_path(self.filename)):
+      os.remove(osc.compiled_cache_path(self.filename))
+    os.remove(self.filename)
+    osc.event_log.drain()
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(name, **values):
+  print("  {0:<34}".format(name) + "  ".join("{0}={1}".format(key, value) for key, value in values.items()))
+
+def ms(seconds):
+  return "{0:.3f}ms".format(seconds * 1000)
+
+### Compilation of the YAML file into scene plans
+
+def bench_compile(scene_counts):
+  print("\nCompile (SceneParser.parseFromFile)")
+  cases = [("{0} scenes".format(count), count, {}) for count in scene_counts]
+  cases.append(("1000 scenes, map depth 12", 1000, { 'depth': 12 }))
+  cases.append(("1000 scenes, 200-item lists", 1000, { 'list_size': 200 }))
+  cases.append(("1000 scenes, 16 endpoints", 1000, { 'endpoint_count': 16 }))
+
+  for name, count, kwargs in cases:
+    rig = Rig(count, **kwargs)
+    report(name, time="{0:.3f}s".format(rig.parse_time), scenes_per_sec=int(count / rig.parse_time))
+    rig.close()
+
+  for count in scene_counts:
+    rig = Rig(count, use_cache=True)
+    warm = rig.reparse()
+    report("{0} scenes, warm compiled cache".format(count), time="{0:.3f}s".format(warm), scenes_per_sec=int(count / warm), cold="{0:.3f}s".format(rig.parse_time))
+    rig.close()
+
+### Scene triggers, from the call into respond_to_scene to the last datagram
+
+def trigger(rig, index):
+  key = rig.keys[index % len(rig.keys)]
+  # Alternate between two scenes so that every trigger is a real change
+  if key == rig.controller.last_scene:
+    key = rig.keys[(index + 1) % len(rig.keys)]
+  return key
+
+def expected_datagrams(rig, key):
+  plan = rig.parser.getScenePlans()[key]
+  count = sum(len(bucket.packets) for bucket in plan.buckets)
+  # One "on" message for the new scene and two "off" messages for the last one
+  return count + (3 if rig.controller.last_scene is not None else 1)
+
+def bench_dispatch(rig, triggers):
+  latencies = []
+  rig.controller.last_scene = rig.keys[-1]
+  for i in range(triggers):
+    key = trigger(rig, i)
+    target = rig.received() + expected_datagrams(rig, key)
+    start = time.perf_counter()
+    rig.controller.respond_to_scene("/scene/" + key, 1)
+    if not rig.wait_for(target):
+      print("  Lost datagrams while triggering scene " + key)
+      continue
+    latencies.append(rig.last_time() - start)
+  osc.event_log.drain()
+  return latencies
+
+def bench_dispatch_throughput(rig, triggers):
+  rig.controller.last_scene = rig.keys[-1]
+  before = rig.received()
+  expected = 0
+  start = time.perf_counter()
+  for i in range(triggers):
+    key = trigger(rig, i)
+    expected += expected_datagrams(rig, key)
+    rig.controller.respond_to_scene("/scene/" + key, 1)
+  elapsed = time.perf_counter() - start
+  rig.wait_for(before + expected)
+  osc.event_log.drain()
+  return elapsed, expected, rig.received() - before
+
+def bench_scenes(scene_counts, triggers):
+  print("\nScene dispatch (respond_to_scene -> last datagram on the wire)")
+  for count in scene_counts:
+    rig = Rig(count)
+    latencies = bench_dispatch(rig, triggers)
+    elapsed, expected, received = bench_dispatch_throughput(rig, triggers)
+    report("{0} scenes".format(count),
+      p50=ms(percentile(latencies, 0.5)), p90=ms(percentile(latencies, 0.9)), p99=ms(percentile(latencies, 0.99)),
+      triggers_per_sec=int(triggers / elapsed), packets_per_sec=int(expected / elapsed), lost=expected - received)
+    rig.close()
+
+  print("\nCold start sweep (last scene unknown, every other scene is turned off)")
+  for count in scene_counts[:2]:
+    rig = Rig(count)
+    rig.controller.last_scene = None
+    start = time.perf_counter()
+    rig.controller.respond_to_scene("/scene/" + rig.keys[0], 1)
+    report("{0} scenes".format(count), handler_time=ms(time.perf_counter() - start), pending_sends=len(rig.controller.scheduler))
+    rig.controller.scheduler.cancel_all()
+    rig.close()
+
+### Lazy compilation: load time, then the first and later triggers of each scene
+
+def bench_lazy(scene_counts, triggers):
+  print("\nLazy compilation (--lazy, respond_to_scene -> last datagram on the wire)")
+  for count in scene_counts:
+    rig = Rig(count, lazy=True)
+    # Each scene is triggered once cold, then the same scenes again
+    cold = bench_dispatch(rig, min(triggers, count))
+    hot = bench_dispatch(rig, min(triggers, count))
+    lazy_scenes = rig.parser.getConfig().lazy_scenes
+    report("{0} scenes".format(count), load="{0:.3f}s".format(rig.parse_time),
+      first_p50=ms(percentile(cold, 0.5)), first_p99=ms(percentile(cold, 0.99)),
+      hot_p50=ms(percentile(hot, 0.5)), hot_p99=ms(percentile(hot, 0.99)),
+      compiled=len(lazy_scenes), held="{0:.1f}MB".format(lazy_scenes.size / (1024 * 1024)))
+    rig.close()
+
+### Delayed cues, from the scene trigger to each cue's arrival against its planned offset
+
+def bench_cues(triggers, cues = 8, stagger_ms = 25, budget_ms = 2.0):
+  print("\nCue timing ({0} cues {1}ms apart per scene, budget {2}ms)".format(cues, stagger_ms, budget_ms))
+  for engine in ("thread", "asyncio"):
+    rig = Rig(2, endpoint_count=1, generator=generate_cue_config, cues=cues, stagger_ms=stagger_ms)
+    if engine == "asyncio":
+      rig.controller.engine_name = engine
+      rig.controller.start(free_port())
+    sink = rig.sinks[0]
+    errors = []
+    rig.controller.last_scene = rig.keys[-1]
+    for i in range(triggers):
+      key = trigger(rig, i)
+      sink.arrivals = []
+      target = rig.received() + expected_datagrams(rig, key)
+      start = time.perf_counter()
+      if engine == "asyncio":
+        rig.controller.engine.loop.call_soon_threadsafe(rig.controller.respond_to_scene, "/scene/" + key, 1)
+      else:
+        rig.controller.respond_to_scene("/scene/" + key, 1)
+      if not rig.wait_for(target, timeout=2.0 + cues * stagger_ms / 1000):
+        print("  Lost cues while triggering scene " + key)
+        continue
+      for data, arrived in sink.arrivals:
+        cue = int(data[:data.find(b"\x00")].rsplit(b"/", 1)[1])
+        errors.append(abs(arrived - start - cue * stagger_ms / 1000))
+    if engine == "asyncio":
+      rig.controller.stop()
+    osc.event_log.drain()
+    if len(errors) > 0:
+      late = sum(1 for error in errors if error * 1000 > budget_ms)
+      report(engine, p50=ms(percentile(errors, 0.5)), p99=ms(percentile(errors, 0.99)), max=ms(max(errors)), over_budget=late)
+    rig.close()
+
+def free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+def quiet_parse(parser, filename):
+  # The parser prints the endpoints it loads, which would bury the results
+  with contextlib.redirect_stdout(io.StringIO()):
+    start = time.perf_counter()
+    parser.parseFromFile(filename)
+    return time.perf_counter() - start
+
+### Pass-through routing
+
+def bench_routing(count):
+  print("\nRouting ({0} packets to one endpoint)".format(count))
+  rig = Rig(10)
+  dgram = osc.OSCMessage("/ep0/fader/1", [0.5]).dgram
+  message = osc.OSCMessage("/ep0/fader/1", [0.5])
+
+  cases = [
+    ("route_message", lambda: rig.controller.route_message("/ep0/fader/1", 0.5)),
+    ("send_msg (prebuilt message)", lambda: rig.controller.send_msg(message)),
+    ("forward_raw", lambda: rig.controller.forward_raw(dgram)),
+  ]
+  for name, call in cases:
+    before = rig.received()
+    start = time.perf_counter()
+    for _ in range(count):
+      call()
+    elapsed = time.perf_counter() - start
+    rig.wait_for(before + count)
+    osc.event_log.drain()
+    report(name, packets_per_sec=int(count / elapsed), per_packet="{0:.2f}us".format(elapsed / count * 1e6), lost=count - (rig.received() - before))
+  rig.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmark scene compilation, dispatch and routing')
+  parser.add_argument("--quick", action='store_true', help="Skip the 10k scene cases")
+  parser.add_argument("--triggers", type=int, default=500, help="Scene triggers per dispatch case (Default 500)")
+  parser.add_argument("--cue-triggers", type=int, default=20, help="Scene triggers for the cue timing case (Default 20)")
+  parser.add_argument("--packets", type=int, default=20000, help="Packets per routing case (Default 20000)")
+  parser.add_argument("--log-level", choices=osc.LOG_LEVELS.keys(), default="debug", help="Controller log level while benchmarking (Default debug)")
+  args = parser.parse_args()
+
+  osc.event_log.level = osc.LOG_LEVELS[args.log_level]
+  scene_counts = [10, 100, 1000] if args.quick else [10, 100, 1000, 10000]
+
+  bench_compile(scene_counts[2:])
+  bench_scenes(scene_counts, args.triggers)
+  bench_lazy(scene_counts[1:], args.triggers)
+  bench_cues(args.cue_triggers)
+  bench_routing(args.packets)
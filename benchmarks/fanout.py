@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from benchmark import UDPSink, osc, quiet_parse, report
+from generate_scenes import generate_config, write_config
+
+### Sending one prefix to several receivers, over loopback
+#
+# Routes the same pass-through packets to a single destination, to several
+# destinations of one endpoint, and to a multicast group that as many
+# sockets have joined on 127.0.0.1.  Every receiver must get every packet;
+# the check fails if any of them is short.
+
+GROUP = "239.255.0.1"
+
+class FanoutRig:
+  def __init__(self, receivers):
+    self.single = UDPSink()
+    self.copies = [UDPSink() for _ in range(receivers)]
+    self.members = [UDPSink(GROUP)]
+    self.members += [UDPSink(GROUP, self.members[0].port) for _ in range(receivers - 1)]
+
+    config = generate_config(10, 3, ports=[self.single.port, self.copies[0].port, self.members[0].port])
+    config['endpoints'][1]['destinations'] = ["127.0.0.1:{0}".format(sink.port) for sink in self.copies[1:]]
+    config['endpoints'][2].update({ 'ip': GROUP, 'multicast_ttl': 0, 'multicast_interface': "127.0.0.1" })
+    handle, self.filename = tempfile.mkstemp(suffix=".yaml")
+    os.close(handle)
+    write_config(self.filename, config)
+
+    self.parser = osc.SceneParser()
+    self.parser.use_cache = False
+    quiet_parse(self.parser, self.filename)
+    self.controller = osc.OSCSceneController(self.parser)
+
+  def close(self):
+    for sink in [self.single] + self.copies + self.members:
+      sink.close()
+    os.remove(self.filename)
+    osc.event_log.drain()
+
+def wait_for(sinks, count, timeout = 2.0):
+  deadline = time.perf_counter() + timeout
+  while min(sink.count for sink in sinks) < count and time.perf_counter() < deadline:
+    time.sleep(0.001)
+
+def bench(rig, count):
+  short = 0
+  cases = [
+    ("one destination", "ep0", [rig.single]),
+    ("{0} destinations".format(len(rig.copies)), "ep1", rig.copies),
+    ("multicast, {0} members".format(len(rig.members)), "ep2", rig.members),
+  ]
+  for name, prefix, sinks in cases:
+    dgram = osc.OSCMessage("/{0}/fader/1".format(prefix), [0.5]).dgram
+    start = time.perf_counter()
+    for _ in range(count):
+      rig.controller.forward_raw(dgram)
+    elapsed = time.perf_counter() - start
+    wait_for(sinks, count)
+    osc.event_log.drain()
+    lost = max(count - sink.count for sink in sinks)
+    short += lost > 0
+    report(name, packets_per_sec=int(count / elapsed), per_packet="{0:.2f}us".format(elapsed / count * 1e6), most_lost=lost)
+  return short
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmark and check fan-out and multicast endpoints over loopback')
+  parser.add_argument("--receivers", type=int, default=4, help="Destinations and multicast group members (Default 4)")
+  parser.add_argument("--packets", type=int, default=5000, help="Packets per case (Default 5000)")
+  args = parser.parse_args()
+
+  osc.event_log.level = osc.LOG_LEVELS["warning"]
+  print("\nFan-out ({0} pass-through packets, every receiver should get all of them)".format(args.packets))
+  rig = FanoutRig(args.receivers)
+  try:
+    short = bench(rig, args.packets)
+  finally:
+    rig.close()
+
+  if short > 0:
+    print("\nFAIL: {0} case(s) lost packets on at least one receiver".format(short))
+    sys.exit(1)
+  print("\nOK: every receiver got every packet")
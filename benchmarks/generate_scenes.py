@@ -0,0 +1,94 @@
+import argparse
+import random
+import yaml
+
+### Synthetic scenes.yaml generators for the benchmarks
+#
+# Every endpoint gets three kinds of map entries so that all the paths in
+# SceneParser.get_commands are exercised:
+#   preset  - direct string values ("/prefix/preset/N 1")
+#   deep    - a map nested `depth` levels deep ending in direct values
+#   fixtures - a list-notation map with `list_size` in/out items
+
+def generate_config(scene_count, endpoint_count = 2, ports = None, depth = 3, list_size = 8, presets = 8, delay_every = 0, seed = 1):
+  rng = random.Random(seed)
+
+  if ports is None:
+    ports = [9000 + i for i in range(endpoint_count)]
+
+  endpoints = []
+  mapping = {}
+  for e in range(endpoint_count):
+    prefix = "ep" + str(e)
+    endpoints.append({ 'prefix': prefix, 'ip': '127.0.0.1', 'port': ports[e] })
+
+    deep = { "value" + str(v): "/{0}/deep/{1} {2}".format(prefix, v, v / 10) for v in range(presets) }
+    for level in reversed(range(depth)):
+      deep = { "level" + str(level): deep }
+
+    mapping[prefix] = {
+      'preset': { "p" + str(p): "/{0}/preset/{1} 1".format(prefix, p) for p in range(presets) },
+      'deep': deep,
+      'fixtures': { "f" + str(f): { 'in': "/{0}/fixture/{1} 1".format(prefix, f), 'out': "/{0}/fixture/{1} 0".format(prefix, f) } for f in range(list_size) },
+    }
+
+  scenes = []
+  for s in range(scene_count):
+    scene = { 'name': "Scene " + str(s), 'key': "scene" + str(s) }
+    if s < 128:
+      scene['midi'] = s
+
+    for e in range(endpoint_count):
+      prefix = "ep" + str(e)
+      deep = "value" + str(rng.randrange(presets))
+      for level in reversed(range(depth)):
+        deep = { "level" + str(level): deep }
+
+      fixtures = [ "f" + str(f) for f in range(list_size) if rng.random() < 0.5 ] or [ "none" ]
+      preset = "p" + str(rng.randrange(presets))
+      if delay_every > 0 and s % delay_every == 0:
+        fixtures.append("delay 1s")
+        preset += " 1s"
+
+      scene[prefix] = { 'preset': preset, 'deep': deep, 'fixtures': fixtures }
+    scenes.append(scene)
+
+  return { 'endpoints': endpoints, 'map': mapping, 'scenes': scenes }
+
+def generate_cue_config(scene_count, endpoint_count = 1, ports = None, cues = 8, stagger_ms = 25):
+  # Every scene fires the same cues, cue N delayed by N * stagger_ms, so the
+  # time each one arrives can be checked against its planned offset
+  if ports is None:
+    ports = [9000 + i for i in range(endpoint_count)]
+
+  endpoints = []
+  mapping = {}
+  for e in range(endpoint_count):
+    prefix = "ep" + str(e)
+    endpoints.append({ 'prefix': prefix, 'ip': '127.0.0.1', 'port': ports[e] })
+    mapping[prefix] = { "c" + str(c): { 'go': "/{0}/cue/{1} 1".format(prefix, c) } for c in range(cues) }
+
+  scenes = []
+  for s in range(scene_count):
+    scene = { 'name': "Scene " + str(s), 'key': "scene" + str(s) }
+    for e in range(endpoint_count):
+      scene["ep" + str(e)] = { "c" + str(c): "go {0}ms".format(c * stagger_ms) for c in range(cues) }
+    scenes.append(scene)
+
+  return { 'endpoints': endpoints, 'map': mapping, 'scenes': scenes }
+
+def write_config(filename, config):
+  with open(filename, 'w') as out_file:
+    yaml.safe_dump(config, out_file, default_flow_style=False)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Generate a synthetic scenes.yaml for benchmarking')
+  parser.add_argument("output", metavar="FILE", help="Where to write the generated YAML")
+  parser.add_argument("--scenes", type=int, default=1000, help="Number of scenes (Default 1000)")
+  parser.add_argument("--endpoints", type=int, default=2, help="Number of endpoints (Default 2)")
+  parser.add_argument("--depth", type=int, default=3, help="Levels of map nesting (Default 3)")
+  parser.add_argument("--list-size", type=int, default=8, help="Items in each in/out list (Default 8)")
+  args = parser.parse_args()
+
+  write_config(args.output, generate_config(args.scenes, args.endpoints, depth=args.depth, list_size=args.list_size))
+  print("Wrote {0} scenes to {1}".format(args.scenes, args.output))
@@ -0,0 +1,196 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from threading import Thread, Lock
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import OSCSceneController as osc
+from benchmark import free_port, quiet_parse, percentile, report, ms
+
+### Replay a capture recorded with `OSCSceneController.py --record FILE`
+#
+# Every endpoint in the scenes file is pointed at a local UDP sink and an
+# in-process controller is started on a free port.  The capture is then sent
+# to it at the recorded pace (or faster), and each datagram arriving at a sink
+# is matched back to the pass-through packet with the same address.
+
+class AddressSink:
+  def __init__(self, matcher):
+    self.matcher = matcher
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    self.sock.bind(("127.0.0.1", 0))
+    self.sock.settimeout(0.1)
+    self.port = self.sock.getsockname()[1]
+    self.running = True
+    self.thread = Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while self.running:
+      try:
+        data = self.sock.recv(65535)
+      except socket.timeout:
+        continue
+      except OSError:
+        return
+      self.matcher.received(message_address(data), time.perf_counter())
+
+  def close(self):
+    self.running = False
+    self.thread.join()
+    self.sock.close()
+
+def message_address(data):
+  # The address of a plain message, or None for bundles
+  if data[:1] != b"/":
+    return None
+  end = data.find(b"\x00")
+  return data[:end] if end != -1 else None
+
+class Matcher:
+  def __init__(self):
+    self.lock = Lock()
+    self.pending = defaultdict(deque)
+    self.latencies = []
+    self.datagrams = 0
+    self.last_time = None
+
+  def sent(self, address, sent_time):
+    with self.lock:
+      self.pending[address].append(sent_time)
+
+  def received(self, address, received_time):
+    with self.lock:
+      self.datagrams += 1
+      self.last_time = received_time
+      waiting = self.pending.get(address)
+      if waiting:
+        self.latencies.append(received_time - waiting.popleft())
+
+  def outstanding(self):
+    with self.lock:
+      return sum(len(waiting) for waiting in self.pending.values())
+
+class ReplayRig:
+  def __init__(self, scenes_file, engine = "thread", raw_routing = False):
+    self.matcher = Matcher()
+    with open(scenes_file) as in_file:
+      config = yaml.load(in_file, Loader=osc.yaml_loader())
+
+    self.sinks = []
+    for endpoint in config['endpoints']:
+      sink = AddressSink(self.matcher)
+      endpoint['ip'] = "127.0.0.1"
+      endpoint['port'] = sink.port
+      # Nothing may go out to the show's real receivers
+      endpoint.pop('destinations', None)
+      self.sinks.append(sink)
+    self.feedback = AddressSink(self.matcher)
+
+    handle, self.filename = tempfile.mkstemp(suffix=".yaml")
+    os.close(handle)
+    with open(self.filename, 'w') as out_file:
+      yaml.safe_dump(config, out_file, default_flow_style=False)
+
+    self.parser = osc.SceneParser()
+    self.parser.use_cache = False
+    quiet_parse(self.parser, self.filename)
+
+    self.port = free_port()
+    self.controller = osc.OSCSceneController(self.parser)
+    self.controller.engine_name = engine
+    self.controller.raw_routing = raw_routing
+    self.controller.setOutputAddress("127.0.0.1", self.feedback.port)
+    self.controller.start(self.port)
+
+  def routable(self, data):
+    # Pass-through packets the controller will forward to one of the sinks
+    address = message_address(data)
+    if address is None or address.startswith(b"/scene/") or address.startswith(b"/midi-scene/"):
+      return None
+    slash = address.find(b"/", 1)
+    if address[1:slash if slash != -1 else len(address)] not in self.parser.getForwardTable():
+      return None
+    return address
+
+  def close(self):
+    self.controller.stop()
+    self.controller.scheduler.cancel_all()
+    for sink in self.sinks + [self.feedback]:
+      sink.close()
+    os.remove(self.filename)
+    osc.event_log.drain()
+
+def replay(rig, records, speed):
+  # speed 0 sends as fast as possible, otherwise the recorded gaps are divided by it
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  target = ("127.0.0.1", rig.port)
+  routable = [rig.routable(data) for _, data in records]
+  start = time.perf_counter()
+  for (offset, data), address in zip(records, routable):
+    if speed > 0:
+      due = start + offset / speed
+      wait = due - time.perf_counter()
+      if wait > 0.002:
+        time.sleep(wait - 0.001)
+      while time.perf_counter() < due:
+        pass
+    if address is not None:
+      rig.matcher.sent(address, time.perf_counter())
+    sock.sendto(data, target)
+  elapsed = time.perf_counter() - start
+  sock.close()
+  return start, elapsed, sum(1 for address in routable if address is not None)
+
+def load_records(filename, repeat):
+  records = list(osc.read_capture(filename))
+  if len(records) == 0 or repeat <= 1:
+    return records
+  # Play the capture back to back, each copy starting where the last one ended
+  length = records[-1][0]
+  return [(offset + length * copy, data) for copy in range(repeat) for offset, data in records]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Replay a recorded OSC capture against an in-process controller with local sinks')
+  parser.add_argument("capture", metavar="CAPTURE", help="Capture file written by OSCSceneController.py --record")
+  parser.add_argument("-s", "--scenes", required=True, metavar="FILE", help="Path to the scenes.yaml the capture was recorded with")
+  parser.add_argument("--speed", type=float, default=1.0, help="Playback speed, 2 for twice as fast (Default 1)")
+  parser.add_argument("--max", action='store_true', help="Send as fast as possible, ignoring the recorded timing")
+  parser.add_argument("--repeat", type=int, default=1, help="Play the capture this many times back to back (Default 1)")
+  parser.add_argument("--settle", type=float, default=1.0, help="Seconds to wait for the last datagrams after sending (Default 1)")
+  parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread", help="Controller engine (Default thread)")
+  parser.add_argument("--raw-routing", action='store_true', help="Run the controller with --raw-routing")
+  parser.add_argument("--log-level", choices=osc.LOG_LEVELS.keys(), default="warning", help="Controller log level while replaying (Default warning)")
+  args = parser.parse_args()
+
+  osc.event_log.level = osc.LOG_LEVELS[args.log_level]
+  records = load_records(args.capture, args.repeat)
+  speed = 0 if args.max else args.speed
+
+  rig = ReplayRig(args.scenes, args.engine, args.raw_routing)
+  try:
+    start, elapsed, expected = replay(rig, records, speed)
+    deadline = time.perf_counter() + args.settle
+    while rig.matcher.outstanding() > 0 and time.perf_counter() < deadline:
+      time.sleep(0.01)
+    matcher = rig.matcher
+    lost = matcher.outstanding()
+  finally:
+    rig.close()
+
+  print("\nReplayed {0} packets from {1} at {2}".format(len(records), args.capture, "maximum speed" if speed == 0 else "{0:g}x".format(speed)))
+  report("sent", packets=len(records), seconds="{0:.3f}".format(elapsed), packets_per_sec=int(len(records) / elapsed) if elapsed > 0 else 0)
+  receive_window = (matcher.last_time - start) if matcher.last_time is not None else 0
+  report("received", datagrams=matcher.datagrams, datagrams_per_sec=int(matcher.datagrams / receive_window) if receive_window > 0 else 0)
+  report("pass-through", expected=expected, lost=lost, loss="{0:.2f}%".format(100 * lost / expected if expected > 0 else 0))
+  if len(matcher.latencies) > 0:
+    latencies = matcher.latencies
+    report("latency", p50=ms(percentile(latencies, 0.5)), p90=ms(percentile(latencies, 0.9)), p99=ms(percentile(latencies, 0.99)), max=ms(max(latencies)))
@@ -0,0 +1,47 @@
+import argparse
+import math
+import sys
+
+from benchmark import Rig, percentile, report
+
+### How load time grows with the length of in/out lists
+#
+# Loads the same number of scenes with longer and longer list-notation maps
+# and fits a line to log(load time) against log(list length).  A slope of 1
+# is linear growth and 2 is quadratic; the check fails above --max-slope.
+
+def load_time(scene_count, list_size, runs):
+  times = []
+  for _ in range(runs):
+    rig = Rig(scene_count, endpoint_count=1, list_size=list_size)
+    times.append(rig.parse_time)
+    rig.close()
+  return percentile(times, 0.5)
+
+def slope(points):
+  xs = [math.log(x) for x, _ in points]
+  ys = [math.log(y) for _, y in points]
+  mean_x = sum(xs) / len(xs)
+  mean_y = sum(ys) / len(ys)
+  return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum((x - mean_x) ** 2 for x in xs)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Check that scene compilation time grows linearly with in/out list length')
+  parser.add_argument("--scenes", type=int, default=200, help="Scenes in each generated configuration (Default 200)")
+  parser.add_argument("--sizes", type=int, nargs='+', default=[50, 100, 200, 400, 800], help="List lengths to load (Default 50 100 200 400 800)")
+  parser.add_argument("--runs", type=int, default=3, help="Loads per list length, the median is used (Default 3)")
+  parser.add_argument("--max-slope", type=float, default=1.15, help="Fail if the fitted log-log slope is above this (Default 1.15)")
+  args = parser.parse_args()
+
+  print("\nLoad time by list length ({0} scenes, no compiled cache)".format(args.scenes))
+  points = []
+  for size in args.sizes:
+    seconds = load_time(args.scenes, size, args.runs)
+    points.append((size, seconds))
+    report("{0}-item lists".format(size), time="{0:.3f}s".format(seconds), per_item="{0:.2f}us".format(seconds / (size * args.scenes) * 1e6))
+
+  fitted = slope(points)
+  if fitted > args.max_slope:
+    print("\nFAIL: load time grows with list length to the power {0:.2f}, above {1:g}".format(fitted, args.max_slope))
+    sys.exit(1)
+  print("\nOK: load time grows with list length to the power {0:.2f}, within {1:g}".format(fitted, args.max_slope))
@@ -0,0 +1,112 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_scenes import generate_config, write_config
+from benchmark import osc, free_port, percentile, report, ms
+
+### Startup time, from exec to the first pass-through packet routed
+#
+# Each run starts a fresh headless controller in its own process and sends
+# one pass-through packet to its input port every millisecond until the
+# first one comes out at a local UDP sink.  This is the gap in routing when
+# the controller is restarted between show segments.
+#
+# How long the interpreter itself takes to start depends on the machine and
+# the site packages installed, so it is measured too, and the threshold
+# applies to the time on top of it.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENTRY_POINTS = {
+  "headless": [os.path.join(ROOT, "headless.py")],
+  "script": [os.path.join(ROOT, "OSCSceneController.py"), "--no-gui"],
+}
+
+def interpreter_start():
+  start = time.perf_counter()
+  subprocess.run([sys.executable, "-c", "pass"], check=True)
+  return time.perf_counter() - start
+
+def start_to_first_packet(command, sink_port, timeout):
+  sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sink.bind(("127.0.0.1", sink_port))
+  sink.setblocking(False)
+  port = free_port()
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  # Pass-through to the sink, which is endpoint "ep0" in the generated file
+  packet = b"/ep0/start\x00\x00,i\x00\x00\x00\x00\x00\x01"
+
+  start = time.perf_counter()
+  process = subprocess.Popen(command + ["-i", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    deadline = start + timeout
+    while time.perf_counter() < deadline:
+      sender.sendto(packet, ("127.0.0.1", port))
+      try:
+        sink.recv(65535)
+        return time.perf_counter() - start
+      except BlockingIOError:
+        pass
+      time.sleep(0.001)
+      if process.poll() is not None:
+        return None
+    return None
+  finally:
+    process.terminate()
+    process.wait()
+    sender.close()
+    sink.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Measure the time from starting the headless controller to its first routed packet')
+  parser.add_argument("--runs", type=int, default=10, help="Starts per case (Default 10)")
+  parser.add_argument("--scenes", type=int, default=100, help="Scenes in the generated configuration (Default 100)")
+  parser.add_argument("--entry", choices=ENTRY_POINTS.keys(), default="headless", help="How to start the controller (Default headless)")
+  parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for the first packet (Default 10)")
+  parser.add_argument("--threshold-ms", type=float, default=50, help="Fail if the median warm start takes this much longer than starting the interpreter (Default 50)")
+  args = parser.parse_args()
+
+  # Every run's sink is bound to the same port, the one in the scenes file
+  probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  probe.bind(("127.0.0.1", 0))
+  sink_port = probe.getsockname()[1]
+  probe.close()
+
+  handle, filename = tempfile.mkstemp(suffix=".yaml")
+  os.close(handle)
+  write_config(filename, generate_config(args.scenes, 1, ports=[sink_port]))
+  print("\nStartup ({0}, {1} scenes, exec -> first pass-through packet at the sink)".format(args.entry, args.scenes))
+  if sys.dont_write_bytecode:
+    print("  PYTHONDONTWRITEBYTECODE is set, so every start compiles the controller from source")
+
+  baseline = [interpreter_start() for _ in range(args.runs)]
+  report("interpreter only", p50=ms(percentile(baseline, 0.5)), min=ms(min(baseline)), max=ms(max(baseline)))
+
+  medians = {}
+  try:
+    for name, extra in (("cold compiled cache", ["--no-cache"]), ("warm compiled cache", []), ("--lazy", ["--lazy"])):
+      times = []
+      for _ in range(args.runs):
+        command = [sys.executable] + ENTRY_POINTS[args.entry] + ["-s", filename, "--log-level", "warning"] + extra
+        elapsed = start_to_first_packet(command, sink_port, args.timeout)
+        if elapsed is None:
+          print("  Controller did not route a packet within {0}s".format(args.timeout))
+          sys.exit(1)
+        times.append(elapsed)
+      medians[name] = percentile(times, 0.5)
+      report(name, p50=ms(percentile(times, 0.5)), min=ms(min(times)), max=ms(max(times)))
+  finally:
+    if os.path.exists(osc.compiled_cache_path(filename)):
+      os.remove(osc.compiled_cache_path(filename))
+    os.remove(filename)
+
+  overhead = medians["warm compiled cache"] - percentile(baseline, 0.5)
+  if overhead * 1000 > args.threshold_ms:
+    print("\nFAIL: median warm start is {0} over the interpreter's, more than the {1:g}ms threshold".format(ms(overhead), args.threshold_ms))
+    sys.exit(1)
+  print("\nOK: median warm start is {0} over the interpreter's, within the {1:g}ms threshold".format(ms(overhead), args.threshold_ms))